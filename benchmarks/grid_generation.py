@@ -0,0 +1,68 @@
+# Name: grid_generation.py
+# Description: Benchmark of the grid generation against the per-cell implementation
+# Usage: python benchmarks/grid_generation.py --cell_size 1000
+
+import argparse
+import time
+
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import box
+
+from geoutils import grid as gr
+
+
+def generate_grid_per_cell(g: gr.grid) -> gpd.GeoDataFrame:
+    """
+    The previous implementation: one Python call and one Shapely object per cell
+    """
+    df = g.generate_point(center=True)["coords"]
+    cell_cds = np.vstack([df.x, df.y]).T
+    cs = np.apply_along_axis(
+        lambda x: box(
+            x[0] - g.cell_size / 2,
+            x[1] - g.cell_size / 2,
+            x[0] + g.cell_size / 2,
+            x[1] + g.cell_size / 2,
+        ),
+        1,
+        cell_cds,
+    )
+    return gpd.GeoDataFrame(cs, columns=["geom"], crs=g.crs, geometry="geom")  # type: ignore
+
+
+def timeit(func, repeat: int):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of grid.generate_grid")
+    # Switzerland and neighbours in EPSG:2056
+    parser.add_argument(
+        "--bbox", type=float, nargs=4, default=[2400000, 1000000, 2900000, 1350000]
+    )
+    parser.add_argument("--cell_size", type=float, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip_per_cell", action="store_true")
+    args = parser.parse_args()
+
+    xmin, ymin, xmax, ymax = args.bbox
+    g = gr.grid(xmin, xmax, ymin, ymax, cell_size=args.cell_size, crs=2056)
+
+    seconds, gdf = timeit(g.generate_grid, args.repeat)
+    print(f"vectorized: {len(gdf)} cells in {seconds:.3f} s")
+
+    if not args.skip_per_cell:
+        seconds_old, gdf_old = timeit(lambda: generate_grid_per_cell(g), args.repeat)
+        print(f"per cell:   {len(gdf_old)} cells in {seconds_old:.3f} s")
+        print(f"speed-up:   {seconds_old / seconds:.1f}x")
+        print(f"identical:  {gdf.geometry.geom_equals_exact(gdf_old.geometry, 0).all()}")
+
+
+if __name__ == "__main__":
+    main()
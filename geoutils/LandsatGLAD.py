@@ -9,6 +9,7 @@ import geopandas as gpd
 import requests
 
 from . import utils as ut
+from .httpClient import HTTPClient
 
 
 def main():
@@ -22,6 +23,8 @@ def main():
     :param count_years: how many years would like to download (int)
     :param username: username for GDAL account
     :param password: password for GDAL account
+    :param retries: The maximum number of the retries of each request. Default: 5
+    :param timeout: The timeout of the requests in seconds. Default: 300
     :return: The saved images in the disk
     """
     parser = argparse.ArgumentParser(
@@ -46,9 +49,21 @@ def main():
     )
     parser.add_argument("--username", help="username for GDAL account ", type=str)
     parser.add_argument("--password", help="password for GDAL account ", type=str)
+    parser.add_argument(
+        "--retries",
+        help="The maximum number of the retries of each request. Default: 5 ",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--timeout",
+        help="The timeout of the requests in seconds. Default: 300 ",
+        type=float,
+        default=300,
+    )
 
     args = parser.parse_args()
-    out_path = args.out_path
+    out_path = Path(args.out_path)
     path_area_of_interest = args.path_aoi
     start_month = args.start_month
     end_month = args.end_month
@@ -62,7 +77,7 @@ def main():
     ymin = region_geometry["coordinates"][0][0][1]
     ymax = region_geometry["coordinates"][0][2][1]
     bbox = (xmin, ymin, xmax, ymax)
-    INPUT_DATA = Path(LandsatGLAD.__file__).parent / "data"  # type: ignore
+    INPUT_DATA = Path(__file__).parent / "data"
     gdf = gpd.read_file(INPUT_DATA / "glad_landsat_tiles.geojson", bbox=bbox)
 
     tiles = list(gdf["TILE"])
@@ -79,23 +94,27 @@ def main():
     url = "https://glad.umd.edu/dataset/landsat_v1.1/{lat}/{tile}/{interval}.tif"
     output = "{p}/{interval}.tif"
 
-    for t in range(len(tiles)):
-        for k in times:
-            if not os.path.exists(out_path / tiles[t]):
-                os.makedirs(out_path / tiles[t])
-
-            if not os.path.exists(out_path / tiles[t] / (str(k) + ".tif")):
-                r = requests.get(
-                    url.format(lat=tiles[t][-3:], tile=tiles[t], interval=k),
-                    auth=(username, password),
-                )
-                print(r.url)
+    with HTTPClient(
+        retries=args.retries,
+        timeout=(10, args.timeout),
+        auth=(username, password) if username is not None else None,  # type: ignore
+    ) as client:
+        for t in range(len(tiles)):
+            for k in times:
+                if not os.path.exists(out_path / tiles[t]):
+                    os.makedirs(out_path / tiles[t])
 
-                print(output.format(p=out_path / tiles[t], interval=k))
-                open(output.format(p=out_path / tiles[t], interval=k), "wb").write(
-                    r.content
-                )
+                if not os.path.exists(out_path / tiles[t] / (str(k) + ".tif")):
+                    _url = url.format(lat=tiles[t][-3:], tile=tiles[t], interval=k)
+                    print(_url)
 
+                    print(output.format(p=out_path / tiles[t], interval=k))
+                    try:
+                        client.download(
+                            _url, output.format(p=out_path / tiles[t], interval=k)
+                        )
+                    except requests.HTTPError as e:
+                        print(f"Failed: {e}")
 
 if __name__ == "__main__":
     main()
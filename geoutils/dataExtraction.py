@@ -3,168 +3,1134 @@
 # Author: Behzad Valipour Sh. <behzad.valipour@swisstph.ch>
 # Date: 20.04.2021 Update:28.04.2021; 29.04.2021, 07.01.2022
 
-from typing import List
+import glob
+import hashlib
+import itertools
+import os
+import re
+import tempfile
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
 import numpy as np
 import numpy.ma as ma
 import numpy.typing as npt
 import pandas as pd
 import geopandas as gpd
 import rasterio as rs
-from rasterio.io import MemoryFile
+import rioxarray
+from rasterio.features import rasterize
+from rasterio.windows import Window
 import xarray as xr
 from affine import Affine
+from pyproj import CRS, Transformer  # type: ignore
 from . import utils as ut
 
+
+PLAN_CACHE_SIZE = 32
+_PLAN_CACHE = OrderedDict()
+
+
+def grid_fingerprint(transform, crs, shape) -> str:
+    """
+    The fingerprint of the raster grid (transform + CRS + shape)
+    """
+    crs = "" if crs is None else CRS.from_user_input(crs).to_wkt()
+    key = repr((tuple(transform)[:6], crs, tuple(shape)))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class SamplingPlan:
+    def __init__(self, rowcol, size: int, transform, crs, shape):
+        """
+        The precomputed pixel indices of the points on a raster grid. The plan can be
+        reused for all the rasters with the same grid, e.g. the dates of a time series.
+        It can be created with `get_sampling_plan`
+
+        :param rowcol: The row/col of the points as (N, 2) array
+        :param size: The number of pixels around the points
+        :param transform: The affine transform of the grid
+        :param crs: The CRS of the grid
+        :param shape: The shape of the grid (height, width)
+        """
+        self.rowcol = np.asarray(rowcol, dtype="int64").reshape(-1, 2)
+        self.size = int(size)
+        self.transform = Affine(*tuple(transform)[:6])
+        self.crs = None if crs is None else CRS.from_user_input(crs).to_wkt()
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.inside = (
+            (self.rowcol[:, 0] >= 0)
+            & (self.rowcol[:, 0] < self.shape[0])
+            & (self.rowcol[:, 1] >= 0)
+            & (self.rowcol[:, 1] < self.shape[1])
+        )
+        self._windows = {}
+
+    @property
+    def grid_key(self) -> str:
+        return grid_fingerprint(self.transform, self.crs, self.shape)
+
+    def windows(self, y_bounds, x_bounds):
+        """
+        Group the points inside the grid by the blocks/chunks of the raster. The window of
+        each group is the block with the buffer margin around it, clipped to the grid as
+        the full read is. The points outside of the grid are NaN in every mode, so they
+        are not grouped
+
+        :param y_bounds: The first row of each block plus the height of the grid
+        :param x_bounds: The first col of each block plus the width of the grid
+        :return: The list of (index of the points, row_off, col_off, row_end, col_end)
+        """
+        y_bounds = np.asarray(y_bounds, dtype="int64")
+        x_bounds = np.asarray(x_bounds, dtype="int64")
+        key = (y_bounds.tobytes(), x_bounds.tobytes())
+        if key in self._windows:
+            return self._windows[key]
+
+        idx_inside = np.flatnonzero(self.inside)
+        rows = self.rowcol[idx_inside, 0]
+        cols = self.rowcol[idx_inside, 1]
+        block_rows = np.searchsorted(y_bounds, rows, side="right") - 1
+        block_cols = np.searchsorted(x_bounds, cols, side="right") - 1
+        n_block_cols = len(x_bounds) - 1
+        blocks, inverse = np.unique(
+            block_rows * n_block_cols + block_cols, return_inverse=True
+        )
+        # Sort the points by block once and split them at the start of each block
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind="stable")
+        groups = np.split(idx_inside[order], np.cumsum(np.bincount(inverse))[:-1])
+
+        windows = []
+        for block, idx in zip(blocks, groups):
+            block_row, block_col = divmod(int(block), n_block_cols)
+            windows.append(
+                (
+                    idx,
+                    max(int(y_bounds[block_row]) - self.size, 0),
+                    max(int(x_bounds[block_col]) - self.size, 0),
+                    min(int(y_bounds[block_row + 1]) + self.size, self.shape[0]),
+                    min(int(x_bounds[block_col + 1]) + self.size, self.shape[1]),
+                )
+            )
+        self._windows[key] = windows
+        return windows
+
+    def save(self, path: str):
+        """
+        Save the plan to the disk as .npz file. The plan is written to a temporary file
+        which is renamed, so the other processes never read a partial file
+        """
+        fd, tmp = tempfile.mkstemp(
+            suffix=".npz", dir=os.path.dirname(os.path.abspath(path))
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(
+                    f,
+                    rowcol=self.rowcol,
+                    size=self.size,
+                    transform=np.asarray(tuple(self.transform)[:6]),
+                    crs="" if self.crs is None else self.crs,
+                    shape=np.asarray(self.shape),
+                )
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path: str) -> "SamplingPlan":
+        """
+        Load the plan saved with `save`
+        """
+        with np.load(path) as f:
+            crs = str(f["crs"])
+            return cls(
+                f["rowcol"],
+                int(f["size"]),
+                f["transform"],
+                crs if crs != "" else None,
+                tuple(f["shape"]),
+            )
+
+
+def _buffer_size(transform, resample_size) -> int:
+    """
+    The number of pixels around the points for the buffer size
+    """
+    if resample_size < 0:
+        raise RuntimeError(f"The sample size cannot be Negative")
+    return int(np.floor((resample_size / abs(transform[0])) / 2))
+
+
+def get_sampling_plan(
+    x,
+    y,
+    points_crs,
+    transform,
+    crs,
+    shape,
+    resample_size,
+    cache_dir: str = None,  # type: ignore
+) -> SamplingPlan:
+    """
+    Get the sampling plan of the points for the raster grid. If the CRS of the points is
+    different from the grid, the points are reprojected. The plans are kept in memory with
+    LRU eviction and optionally saved on the disk, keyed by the fingerprint of the grid,
+    the points and the buffer size.
+
+    :param x: The X coordinates of the points
+    :param y: The Y coordinates of the points
+    :param points_crs: The CRS of the points, None if unknown
+    :param transform: The affine transform of the grid
+    :param crs: The CRS of the grid, None if unknown
+    :param shape: The shape of the grid (height, width)
+    :param resample_size: The buffer around the points. For the the point zero should be used
+    :param cache_dir: The directory to persist the plans; default:None
+    :return: SamplingPlan
+    """
+    size = _buffer_size(transform, resample_size)
+    x = np.asarray(x, dtype="float64")
+    y = np.asarray(y, dtype="float64")
+    points_crs = None if points_crs is None else CRS.from_user_input(points_crs)
+    key = hashlib.sha1(grid_fingerprint(transform, crs, shape).encode())
+    key.update(x.tobytes())
+    key.update(y.tobytes())
+    key.update(("" if points_crs is None else points_crs.to_wkt()).encode())
+    key.update(repr(resample_size).encode())
+    key = key.hexdigest()
+
+    if key in _PLAN_CACHE:
+        _PLAN_CACHE.move_to_end(key)
+        return _PLAN_CACHE[key]
+
+    path = None if cache_dir is None else Path(cache_dir) / f"{key}.npz"
+    if path is not None and path.exists():
+        plan = SamplingPlan.load(str(path))
+    else:
+        if points_crs is not None and crs is not None:
+            crs = CRS.from_user_input(crs)
+            if not points_crs.equals(crs):
+                x, y = Transformer.from_crs(points_crs, crs, always_xy=True).transform(
+                    x, y
+                )
+        rowcol = ut.rowcol_from_transform(transform, x, y)
+        plan = SamplingPlan(rowcol, size, transform, crs, shape)
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            plan.save(str(path))
+
+    _PLAN_CACHE[key] = plan
+    if len(_PLAN_CACHE) > PLAN_CACHE_SIZE:
+        _PLAN_CACHE.popitem(last=False)
+    return plan
+
+
+def _get_plan(
+    gdf: gpd.GeoDataFrame,
+    transform,
+    crs,
+    shape,
+    resample_size,
+    plan: SamplingPlan,
+    cache_dir: str,
+) -> SamplingPlan:
+    """
+    Check the plan determined by the user or get the plan of the points for the grid
+    """
+    if plan is not None:
+        if plan.grid_key != grid_fingerprint(transform, crs, shape):
+            raise RuntimeError(f"The sampling plan was created for another grid")
+        if len(plan.rowcol) != len(gdf):
+            raise RuntimeError(f"The sampling plan was created for other points")
+        if plan.size != _buffer_size(transform, resample_size):
+            raise RuntimeError(f"The sampling plan was created for another sample size")
+        return plan
+    return get_sampling_plan(
+        gdf["geometry"].x.values,
+        gdf["geometry"].y.values,
+        gdf.crs,
+        transform,
+        crs,
+        shape,
+        resample_size,
+        cache_dir,
+    )
+
+
+def _resolve_nearest(
+    plan: SamplingPlan, valid, nearest: float
+) -> Tuple[SamplingPlan, np.ndarray]:
+    """
+    Move the points of the plan which are outside of the grid or on the invalid pixels to
+    the nearest valid pixel within the distance (in the unit of the grid)
+    """
+    rowcol, substituted = ut.nearest_valid_pixel(
+        valid, plan.rowcol, nearest / abs(plan.transform[0])
+    )
+    plan = SamplingPlan(rowcol, plan.size, plan.transform, plan.crs, plan.shape)
+    return plan, substituted
+
+
+def _valid_pixels(band, mask: bool, nodata):
+    """
+    The mask of the valid pixels of the band (numpy or xarray). The nodata value is
+    invalid only if the mask is requested
+    """
+    if isinstance(band, xr.DataArray):
+        valid = band.notnull()
+    else:
+        valid = ~np.isnan(band)
+    if mask == True:
+        valid &= band != nodata
+    return valid
+
+
+def _valid_geotif(img, mask: bool, nodata, windowed: bool) -> np.ndarray:
+    """
+    The mask of the valid pixels from the first band of the raster. In the windowed mode
+    the band is read block by block, so only the boolean mask is held in memory
+    """
+    if windowed == False:
+        return _valid_pixels(img.read(1, out_dtype="float32"), mask, nodata)
+    valid = np.empty(img.shape, dtype=bool)
+    for _, window in img.block_windows(1):
+        band = img.read(1, window=window, out_dtype="float32")
+        valid[window.toslices()] = _valid_pixels(band, mask, nodata)
+    return valid
+
+
+def _block_bounds(length: int, block: int):
+    """
+    The first index of each block plus the length
+    """
+    return np.append(np.arange(0, length, block), length)
+
+
+def _sample_band(band, rowcol, size: int, mask: bool, nodata):
+    """
+    Sample the band at the points with the kernels in utils
+    """
+    if size == 0:
+        if mask == False:
+            return ut.extract_point(band, rowcol)
+        else:
+            raise RuntimeError(f"Extracting point cannot be with mask")
+    else:
+        if mask == False:
+            return ut.extract_point_buffer(band, rowcol, size)
+        else:
+            return ut.extract_point_buffer_mask(band, rowcol, size, nodata)
+
+
+def _band_sampler(size: int, stats: Union[str, List[str]], mask: bool, nodata):
+    """
+    Return the function to sample a band at the points. It returns the dictionary
+    of the extracted values for each statistic
+    """
+    if stats == "mean":
+        return lambda band, rowcol: {
+            "mean": _sample_band(band, rowcol, size, mask, nodata)
+        }
+    if isinstance(stats, str):
+        stats = [stats]
+    nd = nodata if mask == True else None
+    return lambda band, rowcol: ut.extract_point_buffer_stats(
+        band, rowcol, size, stats, nd
+    )
+
+
+def _column_name(prefix: str, stat: str, stats: Union[str, List[str]]) -> str:
+    """
+    The name of the column for the band/date. The statistic is added if a list is used
+    """
+    if stats == "mean":
+        return prefix
+    return prefix + "_" + stat
+
+
+def _sample_band_windowed(img, b: int, plan: SamplingPlan, sampler):
+    """
+    Sample the band reading only the blocks of the raster which contain points.
+    The points are grouped by the internal block layout of the raster and every
+    block is read with the buffer margin around it, so the memory is bounded by
+    the touched blocks. The points outside of the raster get NaN
+    """
+    block_height, block_width = img.block_shapes[b - 1]
+    windows = plan.windows(
+        _block_bounds(img.height, block_height), _block_bounds(img.width, block_width)
+    )
+
+    extracted_values = {}
+    for idx, row_off, col_off, row_end, col_end in windows:
+        window = Window(col_off, row_off, col_end - col_off, row_end - row_off)
+        band = img.read(b, window=window, out_dtype="float32")
+        local_rowcol = plan.rowcol[idx] - np.array([row_off, col_off])
+        for stat, values in sampler(band, local_rowcol).items():
+            if stat not in extracted_values:
+                extracted_values[stat] = np.full(
+                    len(plan.rowcol), np.nan, dtype="float32"
+                )
+            extracted_values[stat][idx] = values
+
+    return extracted_values
+
+
+def _extract_geotif_bands(
+    img,
+    plan: SamplingPlan,
+    stats: Union[str, List[str]],
+    mask: bool,
+    nodata,
+    windowed: bool,
+) -> Dict[int, Dict[str, np.ndarray]]:
+    """
+    Sample every band of the opened raster at the points of the plan
+    """
+    sampler = _band_sampler(plan.size, stats, mask, nodata)
+    extracted_bands = {}
+    for b in img.indexes:
+        if windowed == True:
+            extracted_bands[b] = _sample_band_windowed(img, b, plan, sampler)
+        else:
+            band = img.read(b, out_dtype="float32")
+            extracted_bands[b] = sampler(band, plan.rowcol)
+
+    return extracted_bands
+
+
+def _spatial_dims(da: xr.DataArray) -> xr.DataArray:
+    """
+    Rename the spatial dimensions of the DataArray to y/x. The dimensions are detected by
+    the rio accessor (y/x, latitude/longitude or the CF attributes) or named lat/lon
+    """
+    from rioxarray.exceptions import MissingSpatialDimensionError
+
+    try:
+        y_dim, x_dim = da.rio.y_dim, da.rio.x_dim
+    except MissingSpatialDimensionError:
+        if "lat" not in da.dims or "lon" not in da.dims:
+            raise RuntimeError(f"The spatial dimensions cannot be found in {da.dims}")
+        y_dim, x_dim = "lat", "lon"
+    if (y_dim, x_dim) == ("y", "x"):
+        return da
+    return da.rename({y_dim: "y", x_dim: "x"})
+
+
+def _layers(da: xr.DataArray):
+    """
+    Stack the non-spatial dimensions of the DataArray (e.g. time, band) to one layer
+    dimension and return the label of each layer
+    """
+    da = _spatial_dims(da)
+    dims = [d for d in da.dims if d not in ["y", "x"]]
+    if len(dims) == 0:
+        return da.expand_dims("layer"), ["1"]
+    labels = [list(da.indexes[d].astype(str)) for d in dims]
+    labels = ["_".join(label) for label in itertools.product(*labels)]
+    if len(dims) > 1:
+        da = da.stack(layer=dims)
+    else:
+        da = da.rename({dims[0]: "layer"})
+    return da.transpose("layer", "y", "x"), labels
+
+
+def _sample_layers(cube, rowcol, sampler) -> Dict[str, np.ndarray]:
+    """
+    Sample every layer of the 3D array at the points. The result of each statistic is (N, layers)
+    """
+    extracted_values = {}
+    for l in range(cube.shape[0]):
+        band = np.asarray(cube[l], dtype="float32")
+        for stat, values in sampler(band, rowcol).items():
+            if stat not in extracted_values:
+                extracted_values[stat] = np.empty(
+                    (len(rowcol), cube.shape[0]), dtype="float32"
+                )
+            extracted_values[stat][:, l] = values
+    return extracted_values
+
+
+def _sample_chunks(data, plan: SamplingPlan, sampler) -> Dict[str, np.ndarray]:
+    """
+    Sample the dask array (layer, y, x) computing only the chunks which contain points.
+    The points are grouped by the spatial chunks and every group reads its chunk with
+    the buffer margin around it. The groups are computed in parallel by dask and the
+    points outside of the array get NaN
+    """
+    import dask
+
+    windows = plan.windows(
+        np.cumsum((0,) + data.chunks[1]), np.cumsum((0,) + data.chunks[2])
+    )
+    tasks = []
+    for idx, row_off, col_off, row_end, col_end in windows:
+        local_rowcol = plan.rowcol[idx] - np.array([row_off, col_off])
+        window = data[:, row_off:row_end, col_off:col_end]
+        tasks.append(dask.delayed(_sample_layers)(window, local_rowcol, sampler))
+
+    extracted_values = {}
+    for (idx, *_), result in zip(windows, dask.compute(*tasks)):
+        for stat, values in result.items():
+            if stat not in extracted_values:
+                extracted_values[stat] = np.full(
+                    (len(plan.rowcol), data.shape[0]), np.nan, dtype="float32"
+                )
+            extracted_values[stat][idx] = values
+    return extracted_values
+
+
+def _extract_dataarray(
+    da: xr.DataArray,
+    gdf: gpd.GeoDataFrame,
+    resample_size,
+    stats: Union[str, List[str]],
+    mask: bool,
+    nodata,
+    plan: SamplingPlan = None,  # type: ignore
+    cache_dir: str = None,  # type: ignore
+    nearest: float = None,  # type: ignore
+) -> Tuple[Dict[str, Dict[str, np.ndarray]], np.ndarray]:
+    """
+    Sample every layer of the DataArray (e.g. from cube.get_imgs or cube.generate_cube) at
+    the points. If the DataArray is backed by dask, only the chunks with points are computed.
+    If the nearest distance is determined, the points are moved to the nearest pixel which
+    is valid in at least one layer
+    """
+    da, labels = _layers(da)
+    plan = _get_plan(
+        gdf,
+        da.rio.transform(),
+        da.rio.crs,
+        da.shape[1:],
+        resample_size,
+        plan,
+        cache_dir,
+    )
+
+    substituted = None
+    if nearest is not None:
+        valid = _valid_pixels(da, mask, nodata).any("layer").values
+        plan, substituted = _resolve_nearest(plan, valid, nearest)
+
+    sampler = _band_sampler(plan.size, stats, mask, nodata)
+    if da.chunks is None:
+        extracted_values = _sample_layers(da.values, plan.rowcol, sampler)
+    else:
+        extracted_values = _sample_chunks(da.data, plan, sampler)
+
+    extracted_layers = {
+        label: {stat: values[:, l] for stat, values in extracted_values.items()}
+        for l, label in enumerate(labels)
+    }
+    return extracted_layers, substituted
+
+
+class ParquetStream:
+    def __init__(
+        self,
+        path: str,
+        row_group_size: int = 1000000,
+        partition_by_year: bool = False,
+    ):
+        """
+        Write the extracted values to a Parquet dataset batch by batch in long format with
+        the columns point_id, date, band, stat and value (and substituted if the points
+        were moved to the nearest valid pixel). The rows are buffered until a row
+        group is full, so the whole result is never held in memory. The dataset can be
+        partitioned by year (hive style: year=YYYY), the year is the first four digits of the date
+
+        :param path: The directory of the Parquet dataset
+        :param row_group_size: The number of rows in each row group
+        :param partition_by_year: Write one partition for each year; default:False
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._pq = pq
+        self.path = Path(path)
+        self.row_group_size = row_group_size
+        self.partition_by_year = partition_by_year
+        self._writers = {}
+        self._buffers = {}
+
+    def write(
+        self,
+        point_id,
+        date: str,
+        band: int,
+        stat: str,
+        values,
+        substituted=None,
+    ):
+        """
+        Add the values of one band/date/statistic for all the points
+
+        :param substituted: The points moved to the nearest valid pixel; default:None
+        """
+        partition = ""
+        if self.partition_by_year:
+            year = re.search(r"\d{4}", date)
+            if year is None:
+                raise RuntimeError(f"The year cannot be found in the date: {date}")
+            partition = "year=" + year.group()
+
+        table = self._pa.table(
+            {
+                "point_id": np.asarray(point_id),
+                "date": np.full(len(values), date, dtype=object),
+                "band": np.full(len(values), band, dtype="int32"),
+                "stat": np.full(len(values), stat, dtype=object),
+                "value": np.asarray(values, dtype="float32"),
+            }
+        )
+        if substituted is not None:
+            table = table.append_column(
+                "substituted", self._pa.array(np.asarray(substituted, dtype=bool))
+            )
+        buffer = self._buffers.setdefault(partition, [])
+        buffer.append(table)
+        if sum(len(t) for t in buffer) >= self.row_group_size:
+            self._flush(partition)
+
+    def _flush(self, partition: str):
+        buffer = self._buffers.pop(partition, [])
+        if len(buffer) == 0:
+            return
+        table = self._pa.concat_tables(buffer)
+        if partition not in self._writers:
+            directory = self.path / partition
+            directory.mkdir(parents=True, exist_ok=True)
+            self._writers[partition] = self._pq.ParquetWriter(
+                str(directory / "part-0.parquet"), table.schema
+            )
+        self._writers[partition].write_table(table, row_group_size=self.row_group_size)
+
+    def close(self):
+        for partition in list(self._buffers):
+            self._flush(partition)
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 # Func 01
 def extract_geotif_to_point(
-    rast_path: str,
+    rast_path: Union[str, xr.DataArray],
     date: str,
     gdf_path: str,
     resample_size,
-    stats: str = "mean",
+    stats: Union[str, List[str]] = "mean",
     mask: bool = False,
     nodata: int = 0,
+    windowed: bool = False,
+    plan: SamplingPlan = None,  # type: ignore
+    cache_dir: str = None,  # type: ignore
+    nearest: float = None,  # type: ignore
 ) -> gpd.GeoDataFrame:
     """
     The function extract the values for each date from GeoTIFF raster image
 
-    :param rast_path: (file object or pathlib.Path object)
+    :param rast_path: (file object or pathlib.Path object) or xr.DataArray e.g. from cube.get_imgs. The dask-backed DataArray is computed only for the chunks which contain points
     :param date: when the raster collected (Form: dd_mm_yyyy). it is important for time series data
     :param gdf_path: (str, file object or pathlib.Path object)
     :param resample_size: The buffer around the points. For the the point zero should be used
-    :param stats: The statistics should be used for aggregation
+    :param stats: The statistics should be used for aggregation. A list of mean, median, min, max, std, count and pNN (percentile) calculates all of them in one pass and adds one column per statistic. The default "mean" is NaN if the window contains NaN (as np.mean) while the statistics of a list, e.g. ["mean"], ignore NaN (as np.nanmean)
     :param mask: The nodata value would be masked; default:False
     :param nodata: value which should be consider as NoData value, default:0
+    :param windowed: Read only the blocks of the raster containing points instead of the whole band; default:False
+    :param plan: The sampling plan of the points for the raster grid. If None it is taken from the cache or created; default:None
+    :param cache_dir: The directory to persist the sampling plans; default:None
+    :param nearest: The maximum distance (in the unit of the raster) to move the points which are outside of the raster or on NaN pixels (and nodata if masked) of the first band to the nearest valid pixel. The substituted points are reported in the column "substituted"; default:None
     :return: gpd.GeoDataFrame
     """
-    img = rs.open(rast_path)
     gdf = gpd.read_file(gdf_path)
-    rowcol_tuple = img.index(gdf["geometry"].x, gdf["geometry"].y)
-    rowcol = np.asarray(rowcol_tuple).T
-
-    # Calcualte the pixel size of the image
-    pixel_size = img.transform[0]
-
-    if resample_size >= 0:
-        size = int(np.floor((resample_size / pixel_size) / 2))
+    if isinstance(rast_path, xr.DataArray):
+        extracted_bands, substituted = _extract_dataarray(
+            rast_path,
+            gdf,
+            resample_size,
+            stats,
+            mask,
+            nodata,
+            plan,
+            cache_dir,
+            nearest,
+        )
     else:
-        raise RuntimeError(f"The sample size cannot be Negative")
-
-    for b in img.indexes:
-        band = img.read(b, out_dtype="float32")
-
-        if stats == "mean":
-            if size == 0:
-                if mask == False:
-                    extracted_values = ut.extract_point(band, rowcol)
-                    gdf["b_" + str(b) + "_" + date] = extracted_values
-                else:
-                    raise RuntimeError(f"Extracting point cannot be with mask")
-            else:
-                if mask == False:
-                    extracted_values = ut.extract_point_buffer(band, rowcol, size)
-                    gdf["b_" + str(b) + "_" + date] = extracted_values
-                else:
-                    extracted_values = ut.extract_point_buffer_mask(
-                        band, rowcol, size, nodata
-                    )
-                    gdf["b_" + str(b) + "_" + date] = extracted_values
-        else:
-            raise NameError(f"Mean only supported")
+        img = rs.open(rast_path)
+        plan = _get_plan(
+            gdf, img.transform, img.crs, img.shape, resample_size, plan, cache_dir
+        )
+        substituted = None
+        if nearest is not None:
+            valid = _valid_geotif(img, mask, nodata, windowed)
+            plan, substituted = _resolve_nearest(plan, valid, nearest)
+        extracted_bands = _extract_geotif_bands(
+            img, plan, stats, mask, nodata, windowed
+        )
+    columns = {
+        _column_name("b_" + str(b) + "_" + date, stat, stats): values
+        for b, extracted_values in extracted_bands.items()
+        for stat, values in extracted_values.items()
+    }
+    if substituted is not None:
+        columns["substituted"] = substituted
+    df = pd.DataFrame(columns, index=gdf.index)
+    gdf = gpd.GeoDataFrame(pd.concat([gdf, df], axis=1), crs=gdf.crs)
 
     return gdf
 
 
 # Func 02:
 def extract_netcdf_to_point(
-    ds_path: str,
+    ds_path: Union[str, xr.DataArray],
     gdf_path: str,
     resample_size: int,
-    stats: str = "mean",
+    stats: Union[str, List[str]] = "mean",
     mask: bool = False,
     nodata: int = -9999,
-) -> gpd.GeoDataFrame:
+    chunks: int = None,  # type: ignore
+    plan: SamplingPlan = None,  # type: ignore
+    cache_dir: str = None,  # type: ignore
+    output_path: str = None,  # type: ignore
+    row_group_size: int = 1000000,
+    partition_by_year: bool = False,
+    nearest: float = None,  # type: ignore
+) -> Union[gpd.GeoDataFrame, str]:
 
     """
-    The function extract the values for each date from NetCDF. Since the NetCDF files usually are multi-temporal
-    it is decided to use multi process for each bands which can save a lot of time.
+    The function extract the values for each date from NetCDF. The file is opened once and
+    the row/col of the points are calculated once from the affine transform. The points are
+    gathered for all the dates in one vectorized indexing, and the buffers are calculated
+    date by date from the cube, so the peak memory is at most one copy of the cube. If the
+    output path is determined, the values are streamed to a Parquet dataset (see ParquetStream)
+    date by date instead of adding one column per date.
 
-    :param rast_path: (str, file object or pathlib.Path object)
+    :param rast_path: (str, file object or pathlib.Path object) or xr.DataArray. The dask-backed DataArray is computed only for the chunks which contain points
     :param gdf_path: (str, file object or pathlib.Path object)
     :param resample_size: The buffer around the points. For the the point zero should be used
-    :param stats: The statistics should be used for aggregation
+    :param stats: The statistics should be used for aggregation. A list of mean, median, min, max, std, count and pNN (percentile) calculates all of them in one pass and adds one column per statistic. The default "mean" is NaN if the window contains NaN (as np.mean) while the statistics of a list, e.g. ["mean"], ignore NaN (as np.nanmean)
     :param mask: The nodata value would be masked; default:False
     :param nodata: value which should be consider as NoData value, default:0
-    :return: gpd.GeoDataFrame
+    :param chunks: The number of dates to load at once. If determined the file is opened lazily; default:None
+    :param plan: The sampling plan of the points for the raster grid. If None it is taken from the cache or created; default:None
+    :param cache_dir: The directory to persist the sampling plans; default:None
+    :param output_path: The directory of the Parquet dataset to stream the values; default:None
+    :param row_group_size: The number of rows in each row group of the Parquet dataset
+    :param partition_by_year: Partition the Parquet dataset by year; default:False
+    :param nearest: The maximum distance (in the unit of the raster) to move the points which are outside of the raster or on NaN pixels (and nodata if masked) to the nearest valid pixel (valid in at least one date). The substituted points are reported in the column "substituted", also in the Parquet dataset; default:None
+    :return: gpd.GeoDataFrame or the output path if determined
     """
+    if isinstance(ds_path, xr.DataArray):
+        gdf = gpd.read_file(gdf_path)
+        extracted_layers, substituted = _extract_dataarray(
+            ds_path,
+            gdf,
+            resample_size,
+            stats,
+            mask,
+            nodata,
+            plan,
+            cache_dir,
+            nearest,
+        )
+        if output_path is not None:
+            with ParquetStream(output_path, row_group_size, partition_by_year) as stream:
+                for date, extracted_values in extracted_layers.items():
+                    for stat, values in extracted_values.items():
+                        stream.write(
+                            gdf.index.values, date, 1, stat, values, substituted
+                        )
+            return output_path
+        columns = {
+            _column_name(date, stat, stats): values
+            for date, extracted_values in extracted_layers.items()
+            for stat, values in extracted_values.items()
+        }
+        if substituted is not None:
+            columns["substituted"] = substituted
+        df = pd.DataFrame(columns, index=gdf.index)
+        return gpd.GeoDataFrame(pd.concat([gdf, df], axis=1), crs=gdf.crs)
 
     # Get the general info
-    ds = xr.open_rasterio(ds_path)
-    ds_xarray = xr.open_dataarray(ds_path)
-
-    transform = Affine(*ds.attrs["transform"])
-    count = ds.values.shape[0]
-    height = ds.values.shape[1]
-    width = ds.values.shape[2]
-    dtype = ds.values.dtype
-    pixel_size = ds.attrs["res"][0]
-
-    if pixel_size > 1:
-        crs = ds.attrs["crs"]
+    if chunks is None:
+        ds = xr.open_dataarray(ds_path, decode_coords="all")
     else:
-        crs = 4326
-
-    # Define rasterio object in memory
-    rast = MemoryFile().open(
-        driver="GTiff",  # GDAL GeoTIFF driver
-        count=count,  # number of bands
-        height=height,  # length y
-        width=width,  # length x
-        crs=crs,  # srs
-        dtype=dtype,  # data type
-        nodata=nodata,  # fill value
-        transform=transform,  # affine transformation
-    )
-
-    # Write a data to the raster
-    rast.write(ds.values)
+        ds = xr.open_dataarray(ds_path, decode_coords="all", chunks={"time": chunks})
+    ds = _spatial_dims(ds).transpose("time", "y", "x")
 
     # Prepare the points
     gdf = gpd.read_file(gdf_path)
-    rowcol_tuple = rast.index(gdf["geometry"].x, gdf["geometry"].y)
-    rowcol = np.asarray(rowcol_tuple).T
-
-    if resample_size >= 0:
-        size = int(np.floor((resample_size / pixel_size) / 2))
-    else:
-        raise RuntimeError(f"The sample size cannot be Negative")
+    plan = _get_plan(
+        gdf,
+        ds.rio.transform(),
+        ds.rio.crs,
+        ds.shape[1:],
+        resample_size,
+        plan,
+        cache_dir,
+    )
+    substituted = None
+    if nearest is not None:
+        valid = _valid_pixels(ds, mask, nodata).any("time").values
+        plan, substituted = _resolve_nearest(plan, valid, nearest)
+    rowcol = plan.rowcol
+    size = plan.size
 
     # Create a list of  dates
-    lst_date = list(ds_xarray.indexes["time"].astype(str))
-    # Help Function for parallelization
-    for b, date in zip(rast.indexes, lst_date):
-        band = rast.read(b, out_dtype="float32")
-        if stats == "mean":
-            if size == 0:
-                if mask == False:
-                    # print('b' + str(b) + "_" + date)
-                    extracted_values = ut.extract_point(band, rowcol)
-                    gdf[date] = extracted_values
-                else:
-                    raise RuntimeError(f"Extracting point cannot be with mask")
+    lst_date = list(ds.indexes["time"].astype(str))
+    if size == 0 and stats == "mean" and mask == True:
+        raise RuntimeError(f"Extracting point cannot be with mask")
+
+    sampler = _band_sampler(size, stats, mask, nodata)
+    size_y, size_x = plan.shape
+    step = len(lst_date) if chunks is None else chunks
+    extracted_values = {}
+    stream = None
+    if output_path is not None:
+        stream = ParquetStream(output_path, row_group_size, partition_by_year)
+    with stream if stream is not None else nullcontext():
+        for t0 in range(0, len(lst_date), step):
+            part = ds.isel(time=slice(t0, t0 + step))
+            if size == 0 and stats == "mean":
+                # Gather all the dates at once: (time, point)
+                points = part.isel(
+                    y=xr.DataArray(
+                        np.clip(rowcol[:, 0], 0, size_y - 1), dims="point"
+                    ),
+                    x=xr.DataArray(
+                        np.clip(rowcol[:, 1], 0, size_x - 1), dims="point"
+                    ),
+                )
+                extracted_part = {"mean": points.values.T.astype("float32")}
+                extracted_part["mean"][~plan.inside] = np.nan
             else:
-                if mask == False:
-                    # print('b' + str(b) + "_" + date)
-                    extracted_values = ut.extract_point_buffer(band, rowcol, size)
-                    gdf[date] = extracted_values
-                else:
-                    # print('b' + str(b) + "_" + date)
-                    extracted_values = ut.extract_point_buffer_mask(
-                        band, rowcol, size, nodata
+                extracted_part = _sample_layers(part.values, rowcol, sampler)
+
+            if stream is not None:
+                for t, date in enumerate(lst_date[t0 : t0 + step]):
+                    for stat, values in extracted_part.items():
+                        stream.write(
+                            gdf.index.values,
+                            date,
+                            1,
+                            stat,
+                            values[:, t],
+                            substituted,
+                        )
+                continue
+
+            for stat, values in extracted_part.items():
+                if stat not in extracted_values:
+                    extracted_values[stat] = np.empty(
+                        (len(gdf), len(lst_date)), dtype="float32"
                     )
-                    gdf[date] = extracted_values
-        else:
-            raise NameError(f"Mean only supported")
+                extracted_values[stat][:, t0 : t0 + step] = values
+
+    if stream is not None:
+        return output_path
+
+    # Add the dates at once instead of one column per date
+    columns = {
+        _column_name(date, stat, stats): values[:, t]
+        for t, date in enumerate(lst_date)
+        for stat, values in extracted_values.items()
+    }
+    if substituted is not None:
+        columns["substituted"] = substituted
+    df = pd.DataFrame(columns, index=gdf.index)
+    gdf = gpd.GeoDataFrame(pd.concat([gdf, df], axis=1), crs=gdf.crs)
+
+    return gdf
+
+
+# Func 03
+_BATCH_POINTS = {}
+
+
+def _init_batch_worker(x, y, crs, cache_dir):
+    """
+    Share the points with the worker once instead of sending them with every raster
+    """
+    _BATCH_POINTS.update(x=x, y=y, crs=crs, cache_dir=cache_dir)
+
+
+def _extract_batch_item(
+    rast_path: str,
+    resample_size,
+    stats: Union[str, List[str]],
+    mask: bool,
+    nodata,
+    windowed: bool,
+) -> Dict[int, Dict[str, np.ndarray]]:
+    """
+    Extract all the bands of one raster for the shared points. The sampling plan is
+    cached in the worker, so the rasters with the same grid reuse it
+    """
+    with rs.open(rast_path) as img:
+        plan = get_sampling_plan(
+            _BATCH_POINTS["x"],
+            _BATCH_POINTS["y"],
+            _BATCH_POINTS["crs"],
+            img.transform,
+            img.crs,
+            img.shape,
+            resample_size,
+            _BATCH_POINTS["cache_dir"],
+        )
+        return _extract_geotif_bands(img, plan, stats, mask, nodata, windowed)
+
+
+def extract_geotif_batch(
+    rast_paths: Union[str, List[str]],
+    gdf_path: str,
+    resample_size,
+    dates: List[str] = None,  # type: ignore
+    stats: Union[str, List[str]] = "mean",
+    mask: bool = False,
+    nodata: int = 0,
+    windowed: bool = False,
+    layout: str = "wide",
+    max_workers: int = None,  # type: ignore
+    cache_dir: str = None,  # type: ignore
+    output_path: str = None,  # type: ignore
+    row_group_size: int = 1000000,
+    partition_by_year: bool = False,
+) -> Union[gpd.GeoDataFrame, pd.DataFrame, str]:
+    """
+    The function extract the values from a list of dated GeoTIFF rasters in parallel. The points
+    are read once and shared with the workers of the process pool. If the CRS of a raster is
+    different from the points, the points are reprojected. The sampling plans are cached in
+    each worker, so the rasters with the same grid reuse them. If the output path is determined,
+    the values of each raster are streamed to a Parquet dataset (see ParquetStream) as soon as
+    the raster is done.
+
+    :param rast_paths: The list of the raster paths or a glob pattern e.g. "/data/*.tif"
+    :param gdf_path: (str, file object or pathlib.Path object)
+    :param resample_size: The buffer around the points. For the the point zero should be used
+    :param dates: The date of each raster (Form: dd_mm_yyyy). If None the file name is used; default:None
+    :param stats: The statistics should be used for aggregation. A list of mean, median, min, max, std, count and pNN (percentile) calculates all of them in one pass and adds one column per statistic. The default "mean" is NaN if the window contains NaN (as np.mean) while the statistics of a list, e.g. ["mean"], ignore NaN (as np.nanmean)
+    :param mask: The nodata value would be masked; default:False
+    :param nodata: value which should be consider as NoData value, default:0
+    :param windowed: Read only the blocks of the raster containing points instead of the whole band; default:False
+    :param layout: "wide" to add one column per band and date to the points, or "long" for a table with the columns point_id, date, band, stat and value; default:"wide"
+    :param max_workers: The number of the processes; default:None (number of the CPUs)
+    :param cache_dir: The directory to persist the sampling plans; default:None
+    :param output_path: The directory of the Parquet dataset to stream the values; default:None
+    :param row_group_size: The number of rows in each row group of the Parquet dataset
+    :param partition_by_year: Partition the Parquet dataset by year; default:False
+    :return: gpd.GeoDataFrame for "wide", pd.DataFrame for "long" or the output path if determined
+    """
+    if isinstance(rast_paths, str):
+        rast_paths = sorted(glob.glob(rast_paths))
+    rast_paths = [str(p) for p in rast_paths]
+    if len(rast_paths) == 0:
+        raise RuntimeError(f"No raster is found to extract")
+
+    if dates is None:
+        dates = [Path(p).stem for p in rast_paths]
+    elif len(dates) != len(rast_paths):
+        raise RuntimeError(f"The number of the dates and rasters should be equal")
+
+    if layout not in ["wide", "long"]:
+        raise RuntimeError(f"The layout can be wide or long")
+
+    gdf = gpd.read_file(gdf_path)
+    crs = gdf.crs.to_wkt() if gdf.crs is not None else None
+    x = gdf["geometry"].x.values
+    y = gdf["geometry"].y.values
+
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_batch_worker,
+        initargs=(x, y, crs, cache_dir),
+    ) as executor:
+        results = executor.map(
+            partial(
+                _extract_batch_item,
+                resample_size=resample_size,
+                stats=stats,
+                mask=mask,
+                nodata=nodata,
+                windowed=windowed,
+            ),
+            rast_paths,
+        )
+        if output_path is not None:
+            with ParquetStream(output_path, row_group_size, partition_by_year) as stream:
+                for date, extracted_bands in zip(dates, results):
+                    for b, extracted_values in extracted_bands.items():
+                        for stat, values in extracted_values.items():
+                            stream.write(gdf.index.values, date, b, stat, values)
+            return output_path
+        results = list(results)
+
+    if layout == "wide":
+        columns = {
+            _column_name("b_" + str(b) + "_" + date, stat, stats): values
+            for date, extracted_bands in zip(dates, results)
+            for b, extracted_values in extracted_bands.items()
+            for stat, values in extracted_values.items()
+        }
+        df = pd.DataFrame(columns, index=gdf.index)
+        return gpd.GeoDataFrame(pd.concat([gdf, df], axis=1), crs=gdf.crs)
+
+    frames = [
+        pd.DataFrame(
+            {
+                "point_id": gdf.index.values,
+                "date": date,
+                "band": b,
+                "stat": stat,
+                "value": values,
+            }
+        )
+        for date, extracted_bands in zip(dates, results)
+        for b, extracted_values in extracted_bands.items()
+        for stat, values in extracted_values.items()
+    ]
+    return pd.concat(frames, ignore_index=True)
+
+
+# Func 04
+ZONAL_STATS = ["sum", "mean", "min", "max", "count"]
+_LABEL_CACHE = {}
+_LABEL_CACHE_SIZE = 8
+
+
+def _zone_labels(gdf: gpd.GeoDataFrame, transform, shape, all_touched: bool):
+    """
+    Rasterize the polygons onto the raster grid and sort the pixels by zone. The result
+    is cached for the grid and polygons, so the stacks with the same grid reuse it.
+    The overlapping polygons get the pixels of the last polygon
+
+    :return: The flat index of the pixels sorted by zone, the zones and the start of each zone
+    """
+    key = (
+        tuple(transform),
+        tuple(shape),
+        all_touched,
+        hashlib.sha1(b"".join(gdf.geometry.to_wkb())).hexdigest(),
+    )
+    if key not in _LABEL_CACHE:
+        labels = rasterize(
+            ((geom, i + 1) for i, geom in enumerate(gdf.geometry)),
+            out_shape=shape,
+            transform=transform,
+            fill=0,
+            all_touched=all_touched,
+            dtype="int32",
+        ).ravel()
+        pixels = np.flatnonzero(labels)
+        order = pixels[np.argsort(labels[pixels], kind="stable")]
+        zones, starts = np.unique(labels[order], return_index=True)
+        if len(_LABEL_CACHE) >= _LABEL_CACHE_SIZE:
+            del _LABEL_CACHE[next(iter(_LABEL_CACHE))]
+        _LABEL_CACHE[key] = (order, zones - 1, starts)
+    return _LABEL_CACHE[key]
+
+
+def _zonal_band(band, order, starts, stats: List[str], mask: bool, nodata):
+    """
+    Reduce the pixels of the band sorted by zone to the statistics of each zone
+    """
+    values = band.ravel()[order]
+    valid = ~np.isnan(values)
+    if mask == True:
+        valid &= ~np.isclose(values, nodata)
+
+    count = np.add.reduceat(valid, starts) if len(starts) else np.zeros(0, "int64")
+    extracted_values = {}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for stat in stats:
+            if stat == "count":
+                extracted_values[stat] = count
+            elif stat in ["sum", "mean"]:
+                total = np.add.reduceat(np.where(valid, values, 0), starts)
+                extracted_values[stat] = total if stat == "sum" else total / count
+            elif stat == "min":
+                extracted_values[stat] = np.where(
+                    count > 0,
+                    np.minimum.reduceat(np.where(valid, values, np.inf), starts),
+                    np.nan,
+                )
+            elif stat == "max":
+                extracted_values[stat] = np.where(
+                    count > 0,
+                    np.maximum.reduceat(np.where(valid, values, -np.inf), starts),
+                    np.nan,
+                )
+            else:
+                raise NameError(f"{stat} is not supported. Use {ZONAL_STATS}")
+    return extracted_values
+
+
+def zonal_stats(
+    rast_paths: Union[str, List[str]],
+    gdf_path: str,
+    dates: List[str] = None,  # type: ignore
+    stats: List[str] = ZONAL_STATS,
+    mask: bool = False,
+    nodata: int = 0,
+    all_touched: bool = False,
+) -> gpd.GeoDataFrame:
+    """
+    The function calculate the statistics of the rasters for each polygon. The polygons are
+    rasterized once onto the raster grid as a label array and the statistics of all the zones
+    are calculated together for every band and date. The label array is cached, so the
+    rasters with the same grid reuse it.
+
+    :param rast_paths: The list of the raster paths or a glob pattern e.g. "/data/*.tif"
+    :param gdf_path: (str, file object or pathlib.Path object) of the polygons
+    :param dates: The date of each raster (Form: dd_mm_yyyy). If None the file name is used; default:None
+    :param stats: The list of the statistics: sum, mean, min, max and count
+    :param mask: The nodata value would be masked; default:False
+    :param nodata: value which should be consider as NoData value, default:0
+    :param all_touched: Use all the pixels touched by the polygons instead of the pixels which their center is inside; default:False
+    :return: gpd.GeoDataFrame
+    """
+    if isinstance(rast_paths, str):
+        rast_paths = sorted(glob.glob(rast_paths))
+    rast_paths = [str(p) for p in rast_paths]
+
+    if dates is None:
+        dates = [Path(p).stem for p in rast_paths]
+    elif len(dates) != len(rast_paths):
+        raise RuntimeError(f"The number of the dates and rasters should be equal")
+
+    gdf = gpd.read_file(gdf_path)
+    columns = {}
+    for rast_path, date in zip(rast_paths, dates):
+        with rs.open(rast_path) as img:
+            zones = gdf
+            if gdf.crs is not None and img.crs is not None and gdf.crs != img.crs:
+                zones = gdf.to_crs(img.crs)
+            order, zone_index, starts = _zone_labels(
+                zones, img.transform, img.shape, all_touched
+            )
+            for b in img.indexes:
+                band = img.read(b, out_dtype="float32")
+                extracted_values = _zonal_band(band, order, starts, stats, mask, nodata)
+                for stat, values in extracted_values.items():
+                    column = np.full(len(gdf), 0 if stat == "count" else np.nan)
+                    column[zone_index] = values
+                    columns["b_" + str(b) + "_" + date + "_" + stat] = column
+
+    df = pd.DataFrame(columns, index=gdf.index)
+    gdf = gpd.GeoDataFrame(pd.concat([gdf, df], axis=1), crs=gdf.crs)
 
     return gdf
 
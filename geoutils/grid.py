@@ -3,14 +3,40 @@
 # Author: Behzad Valipour Sh. <behzad.valipour@swisstph.ch>
 # Date: 14.03.2021
 
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Tuple, Union
+
 import geopandas as gpd
 import numpy as np
 import pandas as pd
+import shapely
+from affine import Affine
+from rasterio.features import rasterize
 from shapely.geometry import LineString, MultiPoint, Point, Polygon, box
 
 gpd.GeoDataFrame
 
 
+def boxes(x, y, cell_size: float):
+    """
+    Generate the square cells around the centers. With Shapely 2 all the cells are created
+    in one vectorized call, otherwise one by one
+
+    :param x: The X coordinates of the centers
+    :param y: The Y coordinates of the centers
+    :param cell_size: The size of the cells
+    :return: The array of the polygons
+    """
+    half = cell_size / 2
+    x = np.asarray(x, dtype="float64")
+    y = np.asarray(y, dtype="float64")
+    if hasattr(shapely, "box"):
+        return shapely.box(x - half, y - half, x + half, y + half)
+    cs = np.empty(len(x), dtype=object)
+    cs[:] = [box(i - half, j - half, i + half, j + half) for i, j in zip(x, y)]
+    return cs
+
+
 class grid:
     def __init__(
         self,
@@ -37,15 +63,13 @@ class grid:
         self.cell_size = cell_size
         self.crs = crs
 
-    def generate_point(self, center: bool = True) -> gpd.GeoDataFrame:
-
-        """
-        The function generate the points based on the bbox received from user
-        
-        :param center: whether to generate point for center of the grid or not
-        :return: gpd.GeoDataFrame
+    def _axis_coords(self, center: bool = True):
         """
+        The X and Y coordinates of the columns and rows of the grid
 
+        :param center: whether to use the center of the cells or the left-low corner
+        :return: The X and Y coordinates as 1D arrays
+        """
         if center == True:
             x = np.arange(
                 np.floor(self.xmin) + self.cell_size / 2,
@@ -60,12 +84,31 @@ class grid:
         else:
             x = np.arange(np.floor(self.xmin), np.floor(self.xmax), self.cell_size)
             y = np.arange(np.floor(self.ymin), np.floor(self.ymax), self.cell_size)
+        return x, y
 
+    def generate_point(
+        self, center: bool = True, xy_columns: bool = True, as_array: bool = False
+    ) -> Union[gpd.GeoDataFrame, Tuple[np.ndarray, np.ndarray]]:
+
+        """
+        The function generate the points based on the bbox received from user
+        
+        :param center: whether to generate point for center of the grid or not
+        :param xy_columns: whether to add the X and Y columns or not; default:True
+        :param as_array: return only the X and Y coordinates as arrays without GeoDataFrame; default:False
+        :return: gpd.GeoDataFrame or (X, Y) arrays
+        """
+
+        x, y = self._axis_coords(center)
         xv, yv = np.meshgrid(x, y)
-        df1 = pd.DataFrame({"X": xv.flatten(), "Y": yv.flatten()})
-        df1["coords"] = list(zip(df1["X"], df1["Y"]))
-        df1["coords"] = df1["coords"].apply(Point)
-        gdf1 = gpd.GeoDataFrame(df1, geometry="coords")  # type: ignore
+        xv = xv.ravel()
+        yv = yv.ravel()
+        if as_array == True:
+            return xv, yv
+
+        df1 = pd.DataFrame({"X": xv, "Y": yv}) if xy_columns == True else None
+        gdf1 = gpd.GeoDataFrame(df1, geometry=gpd.points_from_xy(xv, yv))  # type: ignore
+        gdf1 = gdf1.rename_geometry("coords")
 
         if self.crs != 4326:
             gdf1.set_crs(crs=self.crs, inplace=True)
@@ -80,31 +123,81 @@ class grid:
         :return: -> gpd.GeoDataFrame
         """
 
-        df = grid(
-            self.xmin, self.xmax, self.ymin, self.ymax, self.cell_size
-        ).generate_point(center=True)["coords"]
-        cell_cds = np.vstack([df.x, df.y]).T
-        cs = np.apply_along_axis(
-            lambda x: box(
-                x[0] - self.cell_size / 2,
-                x[1] - self.cell_size / 2,
-                x[0] + self.cell_size / 2,
-                x[1] + self.cell_size / 2,
-            ),
-            1,
-            cell_cds,
-        )
+        x, y = self._axis_coords(center=True)
+        xv, yv = np.meshgrid(x, y)
+        cs = boxes(xv.ravel(), yv.ravel(), self.cell_size)
 
-        gdf = gpd.GeoDataFrame(cs, columns=["geom"], crs=self.crs, geometry="geom")  # type: ignore
+        gdf = gpd.GeoDataFrame({"geom": cs}, crs=self.crs, geometry="geom")  # type: ignore
 
         return gdf
 
-    def cells_within_polygon(self, gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    def iter_grid(
+        self,
+        max_cells: int = 1000000,
+        tile: Tuple[int, int] = None,  # type: ignore
+        kind: str = "cells",
+    ) -> Iterator[gpd.GeoDataFrame]:
+
+        """
+        The function generate the Grid (or the points) lazily in row bands or tiles of bounded size,
+        so the large extents can be processed with constant memory. Each cell has a stable global
+        ID (row * number of columns + column, the rows start from ymin) which is the same as the
+        index of `generate_grid`
+
+        :param max_cells: The maximum number of cells in each row band; default:1000000
+        :param tile: The number of (rows, columns) of each tile instead of row bands; default:None
+        :param kind: "cells" for the polygons or "points" for the center of the cells
+        :return: The generator of gpd.GeoDataFrame with the column cell_id
+        """
+        if kind not in ["cells", "points"]:
+            raise RuntimeError(f"The kind can be cells or points")
+
+        x, y = self._axis_coords(center=True)
+        ncols, nrows = len(x), len(y)
+        if tile is None:
+            tile_cols = min(ncols, max_cells)
+            tile_rows = max(max_cells // max(tile_cols, 1), 1)
+        else:
+            tile_rows, tile_cols = tile
+
+        for r0 in range(0, nrows, tile_rows):
+            for c0 in range(0, ncols, tile_cols):
+                cols, rows = np.meshgrid(
+                    np.arange(c0, min(c0 + tile_cols, ncols)),
+                    np.arange(r0, min(r0 + tile_rows, nrows)),
+                )
+                cols = cols.ravel()
+                rows = rows.ravel()
+                cell_id = rows.astype("int64") * ncols + cols
+                if kind == "cells":
+                    geometry = boxes(x[cols], y[rows], self.cell_size)
+                    name = "geom"
+                else:
+                    geometry = gpd.points_from_xy(x[cols], y[rows])
+                    name = "coords"
+                gdf = gpd.GeoDataFrame(
+                    {"cell_id": cell_id}, geometry=geometry, crs=self.crs, index=cell_id
+                )
+                yield gdf.rename_geometry(name)
+
+    def cells_within_polygon(
+        self, gdf: gpd.GeoDataFrame, method: str = "sjoin"
+    ) -> gpd.GeoDataFrame:
         """
         Generate cells inside the polygons
 
+        :param gdf: The polygons
+        :param method: "sjoin" to join the full grid with the polygons, or "raster" to find the cells
+            of each polygon from its bounds with rasterized masks and build only the geometry of
+            the cells which intersect the polygons. The "raster" method adds the column inside
+            which is True for the cells fully inside the polygon; default:"sjoin"
         :return: The geo-dataframe of cells inside the polygons
         """
+        if method == "raster":
+            return self._cells_within_polygon_raster(gdf)
+        elif method != "sjoin":
+            raise RuntimeError(f"The method can be sjoin or raster")
+
         crs = gdf.crs
         grid1 = grid(
             self.xmin,
@@ -114,11 +207,471 @@ class grid:
             cell_size=self.cell_size,
             crs=self.crs,
         ).generate_grid()
-        grid_intersect = gpd.sjoin(grid1, gdf, op="intersects", how="inner")
-        grid_intersect.drop(["index_right", "id"], axis=1, inplace=True)
+        grid_intersect = gpd.sjoin(grid1, gdf, predicate="intersects", how="inner")
+        grid_intersect.drop(
+            ["index_right", "id"], axis=1, inplace=True, errors="ignore"
+        )
 
         return grid_intersect
 
+    def _cells_within_polygon_raster(self, gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+        """
+        Find the cells of each polygon in the window of its bounds. The cells touched by the
+        polygon (all-touched rasterization) and not near its boundary are fully inside; the
+        cells near the boundary are checked with the exact intersection. The index is the
+        global cell ID, the same as the index of `generate_grid`
+        """
+        if gdf.crs is not None and self.crs is not None and gdf.crs != self.crs:
+            gdf = gdf.to_crs(self.crs)
+
+        x, y = self._axis_coords(center=True)
+        ncols, nrows = len(x), len(y)
+        x0 = x[0] - self.cell_size / 2 if ncols else 0
+        y0 = y[0] - self.cell_size / 2 if nrows else 0
+
+        cell_ids, polygons, inside = [], [], []
+        for i, geom in enumerate(gdf.geometry):
+            if geom is None or geom.is_empty:
+                continue
+            minx, miny, maxx, maxy = geom.bounds
+            # The window of the polygon with one cell margin for the touching cells
+            c0 = max(int(np.floor((minx - x0) / self.cell_size)) - 1, 0)
+            c1 = min(int(np.ceil((maxx - x0) / self.cell_size)) + 1, ncols)
+            r0 = max(int(np.floor((miny - y0) / self.cell_size)) - 1, 0)
+            r1 = min(int(np.ceil((maxy - y0) / self.cell_size)) + 1, nrows)
+            if c0 >= c1 or r0 >= r1:
+                continue
+
+            shape = (r1 - r0, c1 - c0)
+            transform = Affine(
+                self.cell_size,
+                0,
+                x0 + c0 * self.cell_size,
+                0,
+                -self.cell_size,
+                y0 + r1 * self.cell_size,
+            )
+            touched = rasterize(
+                [(geom, 1)], out_shape=shape, transform=transform, all_touched=True
+            ).astype(bool)
+            boundary = _dilate(
+                rasterize(
+                    [(geom.boundary, 1)],
+                    out_shape=shape,
+                    transform=transform,
+                    all_touched=True,
+                ).astype(bool)
+            )
+
+            # Raster rows start from the top, grid rows from ymin
+            rows, cols = np.nonzero(touched & ~boundary)
+            ids_inside = (r1 - 1 - rows).astype("int64") * ncols + (c0 + cols)
+
+            rows, cols = np.nonzero(boundary)
+            rows = r1 - 1 - rows
+            cols = c0 + cols
+            candidates = gpd.GeoSeries(boxes(x[cols], y[rows], self.cell_size))
+            hit = candidates.intersects(geom).values
+            within = candidates.within(geom).values
+            ids_boundary = rows[hit].astype("int64") * ncols + cols[hit]
+
+            cell_ids.extend([ids_inside, ids_boundary])
+            polygons.append(np.full(len(ids_inside) + len(ids_boundary), i))
+            inside.extend([np.ones(len(ids_inside), dtype=bool), within[hit]])
+
+        cell_ids = np.concatenate(cell_ids) if cell_ids else np.zeros(0, "int64")
+        polygons = np.concatenate(polygons) if polygons else np.zeros(0, "int64")
+        inside = np.concatenate(inside) if inside else np.zeros(0, bool)
+        order = np.lexsort((polygons, cell_ids))
+        cell_ids, polygons, inside = cell_ids[order], polygons[order], inside[order]
+
+        rows, cols = np.divmod(cell_ids, ncols) if ncols else (cell_ids, cell_ids)
+        attributes = gdf.drop(columns=[gdf.geometry.name, "id"], errors="ignore")
+        grid_intersect = gpd.GeoDataFrame(
+            attributes.iloc[polygons].reset_index(drop=True),
+            geometry=boxes(x[cols], y[rows], self.cell_size),
+            crs=self.crs,
+        ).rename_geometry("geom")
+        grid_intersect["inside"] = inside
+        grid_intersect.index = cell_ids
+        return grid_intersect[["geom"] + list(attributes.columns) + ["inside"]]
+
+    def join_polygons(
+        self,
+        gdf: gpd.GeoDataFrame,
+        columns: List[str] = None,  # type: ignore
+        tile: Tuple[int, int] = (1000, 1000),
+        max_workers: int = None,  # type: ignore
+        geometry: bool = False,
+    ) -> pd.DataFrame:
+        """
+        Tag the cells with the polygons (e.g. administrative units) they overlap and the
+        fraction of the cell area inside of each polygon; the cells which only touch a
+        polygon along an edge or a corner are left out. The grid is split in tiles which
+        are joined with the polygons (STRtree) in parallel processes; the tiles without any
+        polygon are skipped. The result does not depend on the number of processes
+
+        :param gdf: The polygons
+        :param columns: The columns of the polygons to add; default:None (all the columns)
+        :param tile: The number of (rows, columns) of each tile; default:(1000, 1000)
+        :param max_workers: The number of the processes; default:None (number of the CPUs)
+        :param geometry: Add the polygons of the cells as the column geom; default:False
+        :return: One row per cell and polygon with the columns cell_id, polygon (the position
+            of the polygon in gdf), the columns of the polygons and fraction, sorted by
+            cell_id and polygon
+        """
+        if not hasattr(shapely, "STRtree") or not hasattr(shapely, "intersection"):
+            raise RuntimeError(f"join_polygons needs Shapely 2")
+        if gdf.crs is not None and self.crs is not None and gdf.crs != self.crs:
+            gdf = gdf.to_crs(self.crs)
+        if columns is None:
+            columns = [c for c in gdf.columns if c != gdf.geometry.name]
+
+        x, y = self._axis_coords(center=True)
+        ncols, nrows = len(x), len(y)
+        polygons = gdf.geometry.values
+        tree = shapely.STRtree(polygons)
+
+        # Skip the tiles which do not intersect any polygon
+        tile_rows, tile_cols = tile
+        half = self.cell_size / 2
+        tiles = []
+        for r0 in range(0, nrows, tile_rows):
+            for c0 in range(0, ncols, tile_cols):
+                r1 = min(r0 + tile_rows, nrows)
+                c1 = min(c0 + tile_cols, ncols)
+                bounds = shapely.box(
+                    x[c0] - half, y[r0] - half, x[c1 - 1] + half, y[r1 - 1] + half
+                )
+                if len(tree.query(bounds, predicate="intersects")):
+                    tiles.append((r0, r1, c0, c1))
+
+        if tiles:
+            with ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_init_join_worker,
+                initargs=(shapely.to_wkb(polygons), x, y, self.cell_size),
+            ) as executor:
+                results = list(executor.map(_join_tile, tiles))
+            cell_ids = np.concatenate([r[0] for r in results])
+            index = np.concatenate([r[1] for r in results])
+            fraction = np.concatenate([r[2] for r in results])
+        else:
+            cell_ids = np.zeros(0, "int64")
+            index = np.zeros(0, "int64")
+            fraction = np.zeros(0, "float64")
+
+        order = np.lexsort((index, cell_ids))
+        cell_ids, index, fraction = cell_ids[order], index[order], fraction[order]
+        joined = pd.DataFrame({"cell_id": cell_ids, "polygon": index})
+        attributes = gdf[columns].iloc[index].reset_index(drop=True)
+        joined = pd.concat([joined, attributes], axis=1)
+        joined["fraction"] = fraction
+        if geometry:
+            rows, cols = np.divmod(cell_ids, ncols) if ncols else (cell_ids, cell_ids)
+            joined = gpd.GeoDataFrame(
+                joined, geometry=boxes(x[cols], y[rows], self.cell_size), crs=self.crs
+            ).rename_geometry("geom")
+        return joined
+
+
+_JOIN_POLYGONS = {}
+
+
+def _init_join_worker(wkb, x, y, cell_size):
+    """
+    Share the polygons and their STRtree with the worker once instead of every tile
+    """
+    polygons = shapely.from_wkb(wkb)
+    shapely.prepare(polygons)
+    _JOIN_POLYGONS.update(
+        polygons=polygons,
+        tree=shapely.STRtree(polygons),
+        x=x,
+        y=y,
+        cell_size=cell_size,
+    )
+
+
+def _join_tile(tile: Tuple[int, int, int, int]):
+    """
+    Join the cells of the tile (r0, r1, c0, c1) with the polygons
+
+    :return: The cell IDs, the position of the polygons and the fraction of the cell area
+    """
+    r0, r1, c0, c1 = tile
+    x, y = _JOIN_POLYGONS["x"], _JOIN_POLYGONS["y"]
+    cell_size = _JOIN_POLYGONS["cell_size"]
+    cols, rows = np.meshgrid(np.arange(c0, c1), np.arange(r0, r1))
+    cols = cols.ravel()
+    rows = rows.ravel()
+    cells = boxes(x[cols], y[rows], cell_size)
+    i_cell, i_polygon = _JOIN_POLYGONS["tree"].query(cells, predicate="intersects")
+    cells = cells[i_cell]
+    polygons = _JOIN_POLYGONS["polygons"][i_polygon]
+    # Only the cells on the boundary of the polygons need the intersection
+    fraction = np.ones(len(i_cell))
+    boundary = ~shapely.contains_properly(polygons, cells)
+    fraction[boundary] = shapely.area(
+        shapely.intersection(cells[boundary], polygons[boundary])
+    ) / (cell_size * cell_size)
+    # The cells which only touch a polygon along an edge or a corner have no area
+    keep = fraction > 0
+    i_cell, i_polygon = i_cell[keep], i_polygon[keep]
+    cell_ids = rows[i_cell].astype("int64") * len(x) + cols[i_cell]
+    return cell_ids, i_polygon.astype("int64"), fraction[keep]
+
+
+def _dilate(mask):
+    """
+    Add the 8 neighbours of the True cells to the mask
+    """
+    out = mask.copy()
+    out[1:] |= mask[:-1]
+    out[:-1] |= mask[1:]
+    rows = out.copy()
+    out[:, 1:] |= rows[:, :-1]
+    out[:, :-1] |= rows[:, 1:]
+    return out
+
+
+class GridSpec:
+    def __init__(
+        self,
+        xmin: float,
+        ymax: float,
+        cell_size: float,
+        shape: Tuple[int, int],
+        crs: int = 4326,
+    ):
+        """
+        Compact description of a regular grid with the index <-> coordinate math as NumPy
+        operations. The rows start from the top (ymax) like the rasters, so the affine
+        transform can be used with the raster tools. The geometries are only created by
+        `to_geodataframe`
+
+        :param xmin: The left X coordinate of the grid
+        :param ymax: The top Y coordinate of the grid
+        :param cell_size: The size of the cells
+        :param shape: The number of (rows, columns)
+        :param crs: The coordinate system of the grid
+        """
+        self.xmin = xmin
+        self.ymax = ymax
+        self.cell_size = cell_size
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.crs = crs
+
+    @classmethod
+    def from_grid(cls, g: grid) -> "GridSpec":
+        """
+        The GridSpec with the same cells as `grid.generate_grid`
+        """
+        x, y = g._axis_coords(center=True)
+        return cls(
+            x[0] - g.cell_size / 2 if len(x) else np.floor(g.xmin),
+            y[-1] + g.cell_size / 2 if len(y) else np.floor(g.ymin),
+            g.cell_size,
+            (len(y), len(x)),
+            g.crs,
+        )
+
+    @classmethod
+    def from_transform(cls, transform, shape, crs=None) -> "GridSpec":
+        """
+        The GridSpec of a north-up raster with square pixels
+        """
+        if transform.b != 0 or transform.d != 0 or transform.a != -transform.e:
+            raise RuntimeError(f"Only north-up rasters with square pixels are supported")
+        return cls(transform.c, transform.f, transform.a, shape, crs)
+
+    @property
+    def transform(self) -> Affine:
+        return Affine(self.cell_size, 0, self.xmin, 0, -self.cell_size, self.ymax)
+
+    @property
+    def bounds(self) -> Tuple[float, float, float, float]:
+        return (
+            self.xmin,
+            self.ymax - self.shape[0] * self.cell_size,
+            self.xmin + self.shape[1] * self.cell_size,
+            self.ymax,
+        )
+
+    def __len__(self) -> int:
+        return self.shape[0] * self.shape[1]
+
+    def __getitem__(self, key) -> "GridSpec":
+        """
+        The sub-grid e.g. spec[10:20, 5:15]
+        """
+        row_slice, col_slice = key
+        rows = range(self.shape[0])[row_slice]
+        cols = range(self.shape[1])[col_slice]
+        if rows.step != 1 or cols.step != 1:
+            raise RuntimeError(f"Only the slices with step 1 are supported")
+        return GridSpec(
+            self.xmin + cols.start * self.cell_size,
+            self.ymax - rows.start * self.cell_size,
+            self.cell_size,
+            (len(rows), len(cols)),
+            self.crs,
+        )
+
+    def xy_to_cell(self, x, y) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The row and column of the cells containing the points. Use `contains` to check the
+        points outside of the grid
+
+        :return: The rows and columns as int64 arrays
+        """
+        cols = np.floor((np.asarray(x, dtype="float64") - self.xmin) / self.cell_size)
+        rows = np.floor((self.ymax - np.asarray(y, dtype="float64")) / self.cell_size)
+        return rows.astype("int64"), cols.astype("int64")
+
+    def cell_to_xy(self, rows, cols) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The center of the cells
+        """
+        x = self.xmin + (np.asarray(cols) + 0.5) * self.cell_size
+        y = self.ymax - (np.asarray(rows) + 0.5) * self.cell_size
+        return x, y
+
+    def cell_bounds(self, rows, cols) -> Tuple[np.ndarray, ...]:
+        """
+        The bounds of the cells as (xmin, ymin, xmax, ymax) arrays
+        """
+        x0 = self.xmin + np.asarray(cols) * self.cell_size
+        y1 = self.ymax - np.asarray(rows) * self.cell_size
+        return x0, y1 - self.cell_size, x0 + self.cell_size, y1
+
+    def contains(self, rows, cols) -> np.ndarray:
+        """
+        Check which cells are inside of the grid
+        """
+        rows = np.asarray(rows)
+        cols = np.asarray(cols)
+        return (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+
+    def cell_ids(self, rows, cols) -> np.ndarray:
+        """
+        The ID of the cells in the grid (row * number of columns + column)
+        """
+        return np.asarray(rows, dtype="int64") * self.shape[1] + np.asarray(cols)
+
+    def id_to_cell(self, ids) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The row and column of the cell IDs
+        """
+        return np.divmod(np.asarray(ids, dtype="int64"), self.shape[1])
+
+    def grid_cell_ids(self, rows, cols) -> np.ndarray:
+        """
+        The cell ID of `grid` (index of `generate_grid` and cell_id of `iter_grid`) for a
+        GridSpec created with `from_grid`. The rows of `grid` start from the bottom (ymin)
+        """
+        return (self.shape[0] - 1 - np.asarray(rows, dtype="int64")) * self.shape[
+            1
+        ] + np.asarray(cols)
+
+    def sampling_plan(self, x, y, points_crs, resample_size: int, cache_dir=None):
+        """
+        The sampling plan of the points for the rasters on this grid (see
+        `dataExtraction.get_sampling_plan`)
+        """
+        from .dataExtraction import get_sampling_plan
+
+        return get_sampling_plan(
+            x,
+            y,
+            points_crs,
+            self.transform,
+            self.crs,
+            self.shape,
+            resample_size,
+            cache_dir=cache_dir,
+        )
+
+    def neighbours(
+        self, rows, cols, connectivity: int = 8
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The neighbours of the cells. The neighbours outside of the grid are -1
+
+        :param connectivity: 4 or 8 neighbours
+        :return: The rows and columns of the neighbours as (N, connectivity) arrays
+        """
+        if connectivity == 4:
+            offsets = np.array([(-1, 0), (0, -1), (0, 1), (1, 0)])
+        elif connectivity == 8:
+            offsets = np.array(
+                [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+            )
+        else:
+            raise RuntimeError(f"The connectivity can be 4 or 8")
+        n_rows = np.asarray(rows, dtype="int64").reshape(-1, 1) + offsets[:, 0]
+        n_cols = np.asarray(cols, dtype="int64").reshape(-1, 1) + offsets[:, 1]
+        outside = ~self.contains(n_rows, n_cols)
+        n_rows[outside] = -1
+        n_cols[outside] = -1
+        return n_rows, n_cols
+
+    def to_geodataframe(
+        self, rows=None, cols=None, kind: str = "cells"
+    ) -> gpd.GeoDataFrame:
+        """
+        Materialize the cells (or the center points) as GeoDataFrame with the columns row,
+        col, X and Y (the center). The GeoDataFrame can be used with `generate_BID`
+
+        :param rows: The rows of the cells; default:None (all the cells)
+        :param cols: The columns of the cells; default:None (all the cells)
+        :param kind: "cells" for the polygons or "points" for the center of the cells
+        :return: gpd.GeoDataFrame indexed by the cell ID
+        """
+        if rows is None or cols is None:
+            rows, cols = self.id_to_cell(np.arange(len(self)))
+        rows = np.asarray(rows, dtype="int64")
+        cols = np.asarray(cols, dtype="int64")
+        x, y = self.cell_to_xy(rows, cols)
+        if kind == "cells":
+            geometry, name = boxes(x, y, self.cell_size), "geom"
+        elif kind == "points":
+            geometry, name = gpd.points_from_xy(x, y), "coords"
+        else:
+            raise RuntimeError(f"The kind can be cells or points")
+        gdf = gpd.GeoDataFrame(
+            {"row": rows, "col": cols, "X": x, "Y": y},
+            geometry=geometry,
+            crs=self.crs,
+            index=self.cell_ids(rows, cols),
+        )
+        return gdf.rename_geometry(name)
+
+
+def encode_bid(rows, cols) -> np.ndarray:
+    """
+    Pack the row and the column of the cells in one int64 ID (row << 32 | column). The
+    rows and columns can be negative but must fit in int32
+
+    :param rows: The row of the cells (floor(Y / cell))
+    :param cols: The column of the cells (floor(X / cell))
+    :return: The packed IDs as int64 array
+    """
+    rows = np.asarray(rows, dtype="int64")
+    cols = np.asarray(cols, dtype="int64")
+    return (rows << 32) | (cols & 0xFFFFFFFF)
+
+
+def decode_bid(bids) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Unpack the IDs of `encode_bid`
+
+    :return: The rows and columns as int64 arrays
+    """
+    bids = np.asarray(bids, dtype="int64")
+    cols = ((bids & 0xFFFFFFFF) ^ 0x80000000) - 0x80000000
+    return bids >> 32, cols
+
 
 # Func 03
 def generate_BID(
@@ -128,17 +681,31 @@ def generate_BID(
     x: float = None,  # type: ignore
     y: float = None,  # type: ignore
     circularity: bool = False,
+    encoding: str = "legacy",
 ):
     """
     The function generate ID for each cells in the grid
 
     :param gdf: Geopandas Data Frame
     :param coords: the name of the coordinate column
+    :param cell: The size of the cells; default:1000 with x and y
     :param x: optional: if the center of the cells are available could be determined with y
     :param y: optional
     :param circularity: Determine roundness of polygon https://gis.stackexchange.com/questions/374053/determine-roundness-of-polygon-in-qgis
+    :param encoding: "legacy" for floor(Y/cell)*100000 + floor(X/cell) or "packed" for the
+    collision-free int64 IDs of `encode_bid`
     :return: The unique ID for each cell in the grid
     """
+    if encoding not in ("legacy", "packed"):
+        raise RuntimeError(f"The encoding can be legacy or packed")
+
+    def bid(X, Y):
+        rows = np.floor(Y / cell)
+        cols = np.floor(X / cell)
+        if encoding == "packed":
+            return encode_bid(rows.to_numpy(), cols.to_numpy())
+        return (rows * 100000 + cols).convert_dtypes()
+
     gdf1 = gdf.copy()
     if coords != None:
         if cell == None:
@@ -146,9 +713,7 @@ def generate_BID(
         else:
             gdf1["X"] = gdf1[coords].centroid.x
             gdf1["Y"] = gdf1[coords].centroid.y
-            gdf1["BID"] = (
-                np.floor(gdf1["Y"] / cell) * 100000 + np.floor(gdf1["X"] / cell)
-            ).convert_dtypes()
+            gdf1["BID"] = bid(gdf1["X"], gdf1["Y"])
 
         if circularity == True:
             gdf1["area"] = gdf1[coords].area
@@ -160,9 +725,9 @@ def generate_BID(
             )
             gdf1.drop(["area", "perimeter"], axis=1, inplace=True)
     elif x != None:
-        gdf1["BID"] = (
-            np.floor(gdf1[y] / 1000) * 100000 + np.floor(gdf1[x] / 1000)
-        ).convert_dtypes()
+        if cell == None:
+            cell = 1000
+        gdf1["BID"] = bid(gdf1[x], gdf1[y])
 
         if circularity == True:
             raise RuntimeError(f"it is not polygon")
@@ -171,3 +736,217 @@ def generate_BID(
 
     return gdf1
 
+
+class BIDIndex:
+    def __init__(self, bids):
+        """
+        Sorted index of the packed IDs (see `encode_bid`) to find the position of the
+        cells and their neighbours in a table with binary search
+
+        :param bids: The packed IDs of the table e.g. gdf["BID"]
+        """
+        self.bids = np.asarray(bids, dtype="int64")
+        self.order = np.argsort(self.bids, kind="stable")
+        self.sorted = self.bids[self.order]
+
+    def __len__(self) -> int:
+        return len(self.bids)
+
+    def __contains__(self, bid) -> bool:
+        return bool(self.lookup([bid])[0] >= 0)
+
+    def lookup(self, bids) -> np.ndarray:
+        """
+        The position of the IDs in the table
+
+        :return: The positions as int64 array, -1 for the missing IDs
+        """
+        bids = np.asarray(bids, dtype="int64")
+        pos = np.searchsorted(self.sorted, bids)
+        pos = np.minimum(pos, len(self.sorted) - 1)
+        found = (
+            self.sorted[pos] == bids if len(self.sorted) else np.zeros(bids.shape, bool)
+        )
+        return np.where(found, self.order[pos] if len(self.sorted) else -1, -1)
+
+    def neighbours(
+        self, bids, connectivity: int = 8
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The neighbours of the cells
+
+        :param bids: The packed IDs of the cells
+        :param connectivity: 4 or 8 neighbours
+        :return: The IDs of the neighbours and their position in the table (-1 if missing)
+        as (N, connectivity) arrays
+        """
+        if connectivity == 4:
+            offsets = np.array([(1, 0), (0, -1), (0, 1), (-1, 0)])
+        elif connectivity == 8:
+            offsets = np.array(
+                [(1, -1), (1, 0), (1, 1), (0, -1), (0, 1), (-1, -1), (-1, 0), (-1, 1)]
+            )
+        else:
+            raise RuntimeError(f"The connectivity can be 4 or 8")
+        rows, cols = decode_bid(bids)
+        n_bids = encode_bid(
+            rows.reshape(-1, 1) + offsets[:, 0], cols.reshape(-1, 1) + offsets[:, 1]
+        )
+        return n_bids, self.lookup(n_bids)
+
+
+class HierarchicalGrid:
+    def __init__(
+        self,
+        cell_size: float,
+        factor: int = 10,
+        levels: int = 3,
+        xmin: float = 0,
+        ymin: float = 0,
+        crs: int = 4326,
+    ):
+        """
+        Multi-resolution grid where the cells of each level are divided in factor x factor
+        cells in the level below. The cells have packed IDs (see `encode_bid`) of the row and
+        column from the origin, so the parent of a cell is computed from its ID. With the
+        origin at (0, 0) the IDs are the same as `generate_BID(..., encoding="packed")`
+
+        :param cell_size: The size of the cells of the finest level (level 0)
+        :param factor: The number of cells in each direction merged in the next level e.g. 10
+        for 100 m -> 1 km -> 10 km
+        :param levels: The number of levels
+        :param xmin: The X coordinate of the origin
+        :param ymin: The Y coordinate of the origin
+        :param crs: The coordinate system of the grid
+        """
+        if factor < 2:
+            raise RuntimeError(f"The factor must be at least 2")
+        self.cell_size = cell_size
+        self.factor = int(factor)
+        self.levels = int(levels)
+        self.xmin = xmin
+        self.ymin = ymin
+        self.crs = crs
+
+    @classmethod
+    def from_grid(cls, g: grid, factor: int = 10, levels: int = 3) -> "HierarchicalGrid":
+        """
+        The hierarchical grid with the cells of `grid` as the finest level
+        """
+        xmin, ymin, _, _ = GridSpec.from_grid(g).bounds
+        return cls(g.cell_size, factor, levels, xmin, ymin, g.crs)
+
+    def _check_level(self, level: int):
+        if level < 0 or level >= self.levels:
+            raise RuntimeError(f"The level must be between 0 and {self.levels - 1}")
+
+    def level_size(self, level: int) -> float:
+        """
+        The size of the cells in the level
+        """
+        self._check_level(level)
+        return self.cell_size * self.factor**level
+
+    def xy_to_id(self, x, y, level: int = 0) -> np.ndarray:
+        """
+        The packed IDs of the cells containing the points
+        """
+        size = self.level_size(level)
+        rows = np.floor((np.asarray(y, dtype="float64") - self.ymin) / size)
+        cols = np.floor((np.asarray(x, dtype="float64") - self.xmin) / size)
+        return encode_bid(rows, cols)
+
+    def id_to_xy(self, ids, level: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The center of the cells
+        """
+        size = self.level_size(level)
+        rows, cols = decode_bid(ids)
+        return self.xmin + (cols + 0.5) * size, self.ymin + (rows + 0.5) * size
+
+    def parent_ids(self, ids, levels: int = 1) -> np.ndarray:
+        """
+        The IDs of the parent cells
+
+        :param ids: The packed IDs of the cells
+        :param levels: The number of levels up
+        """
+        rows, cols = decode_bid(ids)
+        step = self.factor**levels
+        return encode_bid(rows // step, cols // step)
+
+    def child_ids(self, ids, levels: int = 1) -> np.ndarray:
+        """
+        The IDs of the children of the cells
+
+        :return: (N, (factor ** levels) ** 2) array of the packed IDs
+        """
+        rows, cols = decode_bid(ids)
+        step = self.factor**levels
+        dr, dc = np.divmod(np.arange(step * step), step)
+        return encode_bid(
+            rows.reshape(-1, 1) * step + dr, cols.reshape(-1, 1) * step + dc
+        )
+
+    def rollup(
+        self,
+        ids,
+        values: Union[pd.DataFrame, pd.Series, np.ndarray],
+        level: int = 1,
+        from_level: int = 0,
+        stats: Union[str, list] = "mean",
+    ) -> pd.DataFrame:
+        """
+        Aggregate the values of the cells to a coarser level
+
+        :param ids: The packed IDs of the cells in from_level
+        :param values: The values of the cells (one column per variable)
+        :param level: The level of the aggregation
+        :param from_level: The level of the cells
+        :param stats: The pandas aggregation(s) e.g. "mean", "sum", "min", "max", "count";
+        with a list the columns are named {column}_{stat}
+        :return: pd.DataFrame indexed by the IDs of level (column "BID")
+        """
+        self._check_level(level)
+        self._check_level(from_level)
+        if level < from_level:
+            raise RuntimeError(f"The level must be coarser than from_level")
+        if isinstance(values, np.ndarray):
+            values = pd.DataFrame(values.reshape(len(values), -1))
+        values = pd.DataFrame(values).reset_index(drop=True)
+        parents = self.parent_ids(ids, level - from_level)
+        out = values.groupby(parents, sort=True).agg(stats)
+        if isinstance(stats, list):
+            out.columns = [f"{col}_{stat}" for col, stat in out.columns]
+        out.index.name = "BID"
+        return out
+
+    def pyramid(
+        self,
+        ids,
+        values: Union[pd.DataFrame, pd.Series, np.ndarray],
+        stats: Union[str, list] = "mean",
+    ) -> dict:
+        """
+        Aggregate the values of the finest cells to all the levels. Each level is computed
+        from the finest cells, so "mean" and "median" are not averages of averages
+
+        :return: dict of level -> pd.DataFrame (see `rollup`)
+        """
+        return {
+            level: self.rollup(ids, values, level, 0, stats)
+            for level in range(1, self.levels)
+        }
+
+    def to_geodataframe(self, ids, level: int = 0) -> gpd.GeoDataFrame:
+        """
+        The polygons of the cells indexed by their IDs
+        """
+        ids = np.asarray(ids, dtype="int64")
+        x, y = self.id_to_xy(ids, level)
+        gdf = gpd.GeoDataFrame(
+            geometry=boxes(x, y, self.level_size(level)),
+            crs=self.crs,
+            index=pd.Index(ids, name="BID"),
+        )
+        return gdf.rename_geometry("geom")
@@ -0,0 +1,215 @@
+# Name: httpClient.py
+# Description: The shared HTTP client of the downloaders with keep-alive, timeouts and retries
+# Author: Behzad Valipour Sh. <behzad.valipour@swisstph.ch>
+# Date: 18.10.2026
+
+import email.utils
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+RETRY_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    # A truncated JSON body
+    getattr(requests.exceptions, "JSONDecodeError", ValueError),
+)
+
+
+def retry_after(response: requests.Response) -> float:
+    """
+    The seconds to wait from the Retry-After header (seconds or HTTP date)
+
+    :return: The seconds or None if the header is missing or invalid
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None  # type: ignore
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None  # type: ignore
+    return max(date.timestamp() - time.time(), 0)
+
+
+class HTTPClient:
+    def __init__(
+        self,
+        retries: int = 5,
+        backoff: float = 1,
+        max_backoff: float = 60,
+        timeout: Union[float, Tuple[float, float]] = (10, 120),
+        pool_connections: int = 10,
+        pool_maxsize: int = 10,
+        retry_status: Tuple[int, ...] = RETRY_STATUS,
+        headers: Dict[str, str] = None,  # type: ignore
+        auth: Tuple[str, str] = None,  # type: ignore
+        sleep: Callable = time.sleep,
+        limiter: Callable = None,  # type: ignore
+    ):
+        """
+        Pooled HTTP session with keep-alive. The connection errors, the timeouts and the
+        responses with the status in retry_status are retried with exponential backoff
+        and full jitter; the Retry-After header of the server is the minimum wait
+
+        :param retries: The maximum number of the retries of each request; default:5
+        :param backoff: The base of the backoff in seconds; default:1
+        :param max_backoff: The maximum wait between the retries in seconds; default:60
+        :param timeout: The (connect, read) timeout in seconds; default:(10, 120)
+        :param pool_connections: The number of the hosts kept in the pool; default:10
+        :param pool_maxsize: The maximum number of the connections per host; default:10
+        :param retry_status: The HTTP status to retry; default:(429, 500, 502, 503, 504)
+        :param headers: The headers of all the requests
+        :param auth: The (username, password) of all the requests
+        :param sleep: The function used to wait between the retries
+        :param limiter: The function called before each retry, e.g. TokenBucket.acquire, so
+            the retries are counted in the rate limit; default:None
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.retry_status = retry_status
+        self.sleep = sleep
+        self.limiter = limiter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=True,
+            max_retries=0,
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if headers is not None:
+            self.session.headers.update(headers)
+        if auth is not None:
+            self.session.auth = auth
+        self.lock = threading.Lock()
+        self.retried = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def wait(
+        self, attempt: int, response: requests.Response = None  # type: ignore
+    ) -> float:
+        """
+        The seconds to wait before the retry number attempt (starting from 0). The
+        Retry-After of the response is not capped by max_backoff
+        """
+        seconds = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+        if response is not None:
+            after = retry_after(response)
+            if after is not None:
+                return max(after, seconds)
+        return seconds
+
+    def _retry(self, send: Callable):
+        """
+        Call send until it does not fail with a retryable error or status
+
+        :param send: The function which sends the request and returns the response
+        :return: The response of the last attempt
+        """
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                response = send()
+            except RETRY_ERRORS:
+                if last:
+                    raise
+                response = None
+            if response is not None:
+                if response.status_code not in self.retry_status or last:
+                    response.raise_for_status()
+                    return response
+                response.close()
+            with self.lock:
+                self.retried += 1
+            self.sleep(self.wait(attempt, response))  # type: ignore
+            if self.limiter is not None:
+                self.limiter()
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """
+        GET the URL with the retries
+
+        :param kwargs: The arguments of requests.Session.get
+        :return: The response; requests.HTTPError if the status is an error
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return self._retry(lambda: self.session.get(url, **kwargs))
+
+    def get_json(self, url: str, headers: Dict[str, str] = None):  # type: ignore
+        """
+        GET the URL and decode the JSON response
+        """
+        return self._retry(
+            lambda: self._decoded(
+                self.session.get(url, headers=headers, timeout=self.timeout)
+            )
+        ).decoded
+
+    @staticmethod
+    def _decoded(response: requests.Response) -> requests.Response:
+        # Decode in the retry loop, so a truncated body is retried as well
+        if response.status_code < 400:
+            response.decoded = response.json()  # type: ignore
+        return response
+
+    def download(
+        self,
+        url: str,
+        path: Union[str, os.PathLike],
+        chunk_size: int = 1048576,
+        **kwargs,
+    ) -> str:
+        """
+        Stream the response to the file. The data is written to path.part and renamed
+        when the download is complete, so an interrupted download never leaves a partial
+        file at path
+
+        :param url: The URL
+        :param path: The path of the file
+        :param chunk_size: The size of the chunks written to the disk; default:1 MB
+        :param kwargs: The arguments of requests.Session.get
+        :return: The path of the file
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        part = f"{path}.part"
+
+        def send():
+            response = self.session.get(url, stream=True, **kwargs)
+            if response.status_code >= 400:
+                return response
+            with response, open(part, "wb") as f:
+                for data in response.iter_content(chunk_size=chunk_size):
+                    f.write(data)
+            return response
+
+        try:
+            self._retry(send)
+        except BaseException:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+        os.replace(part, path)
+        return str(path)
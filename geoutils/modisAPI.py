@@ -7,20 +7,653 @@
 
 # Utilities
 import argparse
+import contextlib
 import datetime as dt
-import json
+import functools
+import hashlib
+import math
 import os
+import re
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Tuple, Union
 
 import numpy as np
-import requests
 import rioxarray
-import xarray as xr
-from pyproj import CRS, Proj  # type: ignore
+import shapely
+import shapely.geometry
+import shapely.ops
+from pyproj import Transformer  # type: ignore
 
-from . import grid as gr
 from . import utils as ut
+from .httpClient import HTTPClient
+from .modisCache import JobManifest, ResponseCache
+
+URL = "https://modis.ornl.gov/rst/api/v1/"
+HEADER = {"Accept": "application/json"}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1):
+        """
+        Thread-safe token bucket to limit the number of the requests per second
+
+        :param rate: The number of the tokens added per second
+        :param capacity: The maximum number of the tokens (the burst); default:1
+        """
+        if rate <= 0:
+            raise RuntimeError(f"The rate must be positive")
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait for one token
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SubsetDownloader:
+    def __init__(
+        self,
+        url: str = URL,
+        rate: float = 1,
+        burst: float = 1,
+        max_workers: int = 4,
+        max_in_flight: int = None,  # type: ignore
+        getter: Callable = None,  # type: ignore
+        header: Dict[str, str] = HEADER,
+        cache: ResponseCache = None,  # type: ignore
+        manifest: JobManifest = None,  # type: ignore
+        bucket: TokenBucket = None,  # type: ignore
+    ):
+        """
+        Download the subsets of the MODIS and VIIRS Land Product Subsets RESTful Web Service
+        in parallel. The requests are limited with a token bucket and the number of the
+        requests in flight instead of the fixed sleeps
+
+        :param url: The base URL of the service (e.g. a local mock for the tests)
+        :param rate: The maximum number of the requests per second; default:1
+        :param burst: The maximum number of the requests sent at once; default:1
+        :param max_workers: The number of the threads; default:4
+        :param max_in_flight: The maximum number of the requests in flight; default:max_workers
+        :param getter: The function (url, headers) -> JSON used for the requests;
+            default:HTTPClient.get_json with one connection per worker, its retries are
+            limited with the token bucket. This client is closed by `close` (or at the
+            end of the with block)
+        :param header: The header of the requests
+        :param cache: The cache of the responses; the cached responses are not requested
+        :param manifest: The manifest of the done tiles
+        :param bucket: The token bucket shared with the retries of the getter;
+            default:TokenBucket(rate, burst)
+        """
+        self.url = url
+        self.header = header
+        self.bucket = bucket if bucket is not None else TokenBucket(rate, burst)
+        self.client = None
+        if getter is None:
+            self.client = HTTPClient(
+                pool_maxsize=max_workers, limiter=self.bucket.acquire
+            )
+            getter = self.client.get_json
+        self.getter = getter
+        self.cache = cache
+        self.manifest = manifest
+        self.max_workers = max_workers
+        self.in_flight = threading.BoundedSemaphore(
+            max_in_flight if max_in_flight is not None else max_workers
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Close the HTTPClient created by the downloader; the getter determined by the
+        user is not closed
+        """
+        if self.client is not None:
+            self.client.close()
+
+    def get(self, url: str):
+        """
+        Request the URL with the rate limit, or read it from the cache
+
+        :return: The JSON response
+        """
+        if self.cache is not None:
+            response = self.cache.get(url)
+            if response is not None:
+                return response
+        self.bucket.acquire()
+        with self.in_flight:
+            response = self.getter(url, self.header)
+        if self.cache is not None:
+            self.cache.put(url, response)
+        return response
+
+    @staticmethod
+    def tile_unit(
+        product: str, band: str, coord, dates: List[str], ab: float, lr: float
+    ) -> str:
+        """
+        The key of the tile in the manifest
+        """
+        first, last = (dates[0], dates[-1]) if len(dates) else ("", "")
+        return JobManifest.unit(product, band, coord[1], coord[0], first, last, ab, lr)
+
+    def products(self, satellite: str):
+        return self.get(self.url + f"products?sensor={satellite}")["products"]
+
+    def bands(self, product: str):
+        return self.get(self.url + f"{product}/bands")["bands"]
+
+    def dates(
+        self, product: str, lat: float, lon: float, sd: dt.date, ed: dt.date
+    ) -> List[str]:
+        """
+        The MODIS dates of the product at the location between sd (included) and ed
+        """
+        dates = self.get(self.url + f"{product}/dates?latitude={lat}&longitude={lon}")
+        return [
+            d["modis_date"]
+            for d in dates["dates"]
+            if sd <= dt.datetime.strptime(d["calendar_date"], "%Y-%m-%d").date() < ed
+        ]
+
+    def _jobs(
+        self,
+        product: str,
+        band: str,
+        coords: List,
+        modis_dates: List[List[str]],
+        number_chunks: int,
+        ab: Union[float, List[float]],
+        lr: Union[float, List[float]],
+    ) -> Tuple[list, List[int]]:
+        """
+        The requests of the tiles which are not done in the manifest
+
+        :return: The list of (tile, chunk, number of the chunks of the tile, dates, URL)
+            and the list of the tiles which are done
+        """
+        abs_ = np.broadcast_to(np.asarray(ab), (len(coords),)).tolist()
+        lrs = np.broadcast_to(np.asarray(lr), (len(coords),)).tolist()
+        jobs, done = [], []
+        for t, (coord, dates) in enumerate(zip(coords, modis_dates)):
+            ab, lr = abs_[t], lrs[t]
+            if self.manifest is not None and self.manifest.done(
+                self.tile_unit(product, band, coord, dates, ab, lr)
+            ):
+                print(f"tile {t + 1}: done")
+                done.append(t)
+                continue
+            chunks = list(ut.chunk(dates, number_chunks))  # type: ignore
+            for i, c in enumerate(chunks):
+                _url = ut.getSubsetURL(
+                    self.url, product, coord[1], coord[0], band, c[0], c[-1], ab, lr
+                )
+                jobs.append((t, i, len(chunks), c, _url))
+        return jobs, done
+
+    def _fetch(self, job):
+        t, i, n, c, _url = job
+        response = self.get(_url)
+        print(f"tile {t + 1}: [ {i + 1} / {n} ] {c[0]} - {c[-1]}")
+        return response
+
+    def download(
+        self,
+        product: str,
+        band: str,
+        coords: List,
+        modis_dates: List[List[str]],
+        number_chunks: int = 10,
+        ab: Union[float, List[float]] = 70,
+        lr: Union[float, List[float]] = 70,
+    ) -> List[list]:
+        """
+        Download the subsets of all the tiles in parallel
+
+        :param product: The product
+        :param band: The band
+        :param coords: The (longitude, latitude) of the center of the tiles
+        :param modis_dates: The MODIS dates of each tile
+        :param number_chunks: The number of the dates per request (maximum 10)
+        :param ab: The km above and below the center (one value or one per tile)
+        :param lr: The km left and right of the center (one value or one per tile)
+        :return: The subsets of each tile in the order of the dates; None for the tiles
+            which are done in the manifest
+        """
+        jobs, done = self._jobs(
+            product, band, coords, modis_dates, number_chunks, ab, lr
+        )
+        subsets = [None if t in done else [] for t in range(len(coords))]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for job, response in zip(jobs, executor.map(self._fetch, jobs)):
+                subsets[job[0]].append(response)  # type: ignore
+        return subsets  # type: ignore
+
+    def iter_download(
+        self,
+        product: str,
+        band: str,
+        coords: List,
+        modis_dates: List[List[str]],
+        number_chunks: int = 10,
+        ab: Union[float, List[float]] = 70,
+        lr: Union[float, List[float]] = 70,
+    ):
+        """
+        Download the subsets of all the tiles in parallel and yield every response as
+        soon as it completes, so the responses are not held in memory (see `download`
+        for the parameters). The tiles which are done in the manifest are skipped
+
+        :return: The generator of (tile, chunk, number of the chunks of the tile,
+            response); the chunk i starts at the date i * number_chunks of the tile
+        """
+        jobs, _ = self._jobs(product, band, coords, modis_dates, number_chunks, ab, lr)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._fetch, job): job for job in jobs}
+            try:
+                for future in as_completed(futures):
+                    t, i, n, _, _ = futures.pop(future)
+                    yield t, i, n, future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+
+@functools.lru_cache(maxsize=64)
+def _transformer(src, dst) -> Transformer:
+    """
+    The always_xy Transformer between the CRSs, cached for the repeated planning
+    """
+    return Transformer.from_crs(src, dst, always_xy=True)
+
+
+def _to_sinusoidal(geometry, crs: int = 4326):
+    """
+    Project the geometry to the MODIS sinusoidal projection. The edges are densified in
+    WGS84 first, so the meridians stay curved as the service cuts them
+    """
+    if crs != 4326:
+        geometry = ut.transform_geometry(_transformer(crs, 4326), geometry)
+    if hasattr(shapely, "segmentize"):
+        geometry = shapely.segmentize(geometry, 0.01)
+    return ut.transform_geometry(_transformer(4326, ut.SINUSOIDAL), geometry)
+
+
+def plan_windows(
+    geometry, max_km: int = 100, crs: int = 4326, pixel_size: float = 1000
+) -> List[Tuple[float, float, int, int]]:
+    """
+    Cover the AOI with the fewest subset windows. The windows are planned in the MODIS
+    sinusoidal projection, where the service cuts them: the AOI is split in rows of the
+    same height (at most 2 * max_km); the part of the AOI in each row is covered by the
+    fewest windows of at most 2 * max_km width and the windows which do not intersect
+    the AOI are dropped. The service snaps the center of the window to its pixel and
+    cuts a whole number of the pixels on each side, so the windows are padded by one
+    pixel
+
+    :param geometry: The GeoJSON geometry (or the Shapely geometry) of the AOI
+    :param max_km: The maximum km above/below and left/right of the API; default:100
+    :param crs: The EPSG code of the AOI; default:4326
+    :param pixel_size: The pixel size of the product in meters; default:1000
+    :return: The (longitude, latitude, km above/below, km left/right) of the windows; no
+        window for an empty AOI
+    """
+    return _plan_windows(geometry, max_km, crs, pixel_size)[0]
+
+
+def _plan_windows(
+    geometry, max_km: int = 100, crs: int = 4326, pixel_size: float = 1000
+):
+    """
+    The windows of `plan_windows` with the boxes in the sinusoidal projection which
+    they cover, i.e. the footprints used to cover the AOI
+    """
+    if not hasattr(geometry, "geom_type"):
+        geometry = shapely.geometry.shape(geometry)
+    if geometry.is_empty:
+        return [], []
+    half = max_km * 1000 - pixel_size
+    if half <= 0:
+        raise RuntimeError(f"The max_km must be larger than the pixel size")
+    aoi = _to_sinusoidal(geometry, crs)
+    to_wgs = _transformer(ut.SINUSOIDAL, 4326)
+
+    minx, miny, maxx, maxy = aoi.bounds
+    rows = max(math.ceil((maxy - miny) / (2 * half)), 1)
+    height = (maxy - miny) / rows
+    ab = math.ceil((height / 2 + pixel_size) / 1000)
+    windows, boxes = [], []
+    for r in range(rows):
+        y0 = miny + r * height
+        y1 = max(y0 + height, y0 + 1)
+        part = aoi.intersection(shapely.geometry.box(minx, y0, maxx, y1))
+        if part.is_empty:
+            continue
+        x0, _, x1, _ = part.bounds
+        cols = max(math.ceil((x1 - x0) / (2 * half)), 1)
+        width = (x1 - x0) / cols
+        lr = math.ceil((width / 2 + pixel_size) / 1000)
+        for c in range(cols):
+            cx0 = x0 + c * width
+            window = shapely.geometry.box(cx0, y0, max(cx0 + width, cx0 + 1), y1)
+            if not window.intersects(part):
+                continue
+            lon, lat = to_wgs.transform(cx0 + width / 2, (y0 + y1) / 2)
+            windows.append((lon, lat, ab, lr))
+            boxes.append(window)
+    return windows, boxes
+
+
+def plan_summary(
+    windows: List[Tuple[float, float, int, int]],
+    dates: int,
+    number_chunks: int = 10,
+    pixel_size: float = 500,
+) -> Dict[str, float]:
+    """
+    The number of the requests and the approximate volume of the download
+
+    :param windows: The windows of `plan_windows`
+    :param dates: The number of the dates
+    :param number_chunks: The number of the dates per request
+    :param pixel_size: The pixel size of the product in meters; default:500
+    :return: dict of windows, requests (including the one /dates request), pixels (per
+        date), values and megabytes (of the JSON responses, about 6 bytes per value)
+    """
+    chunks = math.ceil(dates / number_chunks) if dates else 0
+    pixels = sum(
+        (2 * int(ab * 1000 / pixel_size) + 1) * (2 * int(lr * 1000 / pixel_size) + 1)
+        for _, _, ab, lr in windows
+    )
+    return dict(
+        windows=len(windows),
+        requests=1 + chunks * len(windows),
+        pixels=pixels,
+        values=pixels * dates,
+        megabytes=round(pixels * dates * 6 / 1048576, 1),
+    )
+
+
+def _windows_area(windows) -> float:
+    return sum(4 * ab * lr for _, _, ab, lr in windows)
+
+
+def plan_batch(
+    geometries: List, max_km: int = 100, crs: int = 4326, pixel_size: float = 1000
+) -> Tuple[List[Tuple[float, float, int, int]], List[List[int]]]:
+    """
+    Plan the subset windows of many AOIs together. The overlapping AOIs are merged, so
+    the shared area is downloaded once, and the separate parts are planned together when
+    it does not increase the area of the windows (fewer requests for the same data)
+
+    :param geometries: The GeoJSON geometries (or the Shapely geometries) of the AOIs
+    :param max_km: The maximum km above/below and left/right of the API; default:100
+    :param crs: The EPSG code of the AOIs; default:4326
+    :param pixel_size: The pixel size of the product in meters; default:1000
+    :return: The unique windows (see `plan_windows`) and the indices of the windows which
+        cover each AOI; no window for an empty AOI
+    """
+    aois = []
+    for geometry in geometries:
+        if not hasattr(geometry, "geom_type"):
+            geometry = shapely.geometry.shape(geometry)
+        if crs != 4326:
+            geometry = ut.transform_geometry(_transformer(crs, 4326), geometry)
+        aois.append(geometry)
+    union = shapely.ops.unary_union(aois)
+    parts = [p for p in getattr(union, "geoms", [union]) if not p.is_empty]
+
+    # Greedy grouping of the parts: merge when the windows do not get larger. The parts
+    # are disjoint, so a group is the MultiPolygon of its parts
+    groups = []
+    for part in sorted(parts, key=lambda g: (g.bounds[1], g.bounds[0])):
+        plan = _plan_windows(part, max_km, pixel_size=pixel_size)
+        area = _windows_area(plan[0])
+        for group in groups:
+            merged = group["parts"] + [part]
+            merged_plan = _plan_windows(
+                shapely.geometry.MultiPolygon(merged), max_km, pixel_size=pixel_size
+            )
+            merged_area = _windows_area(merged_plan[0])
+            if (
+                len(merged_plan[0]) <= len(group["plan"][0]) + len(plan[0])
+                and merged_area <= group["area"] + area
+            ):
+                group.update(parts=merged, plan=merged_plan, area=merged_area)
+                break
+        else:
+            groups.append(dict(parts=[part], plan=plan, area=area))
+
+    # The members of the AOI are the windows of its group which intersect it, tested
+    # with the same boxes which were used to cover the group
+    index = {}
+    members = []
+    for aoi in aois:
+        found = set()
+        aoi_sinusoidal = _to_sinusoidal(aoi)
+        for group in groups:
+            windows, boxes = group["plan"]
+            if aoi.is_empty or not any(p.intersects(aoi) for p in group["parts"]):
+                continue
+            for window, box in zip(windows, boxes):
+                if box.intersects(aoi_sinusoidal):
+                    found.add(index.setdefault(window, len(index)))
+        members.append(sorted(found))
+    return list(index), members
+
+
+def band_pixel_size(band: str, default: float = 500) -> float:
+    """
+    The pixel size in meters from the band name e.g. 250m_16_days_NDVI -> 250 or
+    LST_Day_1km -> 1000
+    """
+    found = re.search(r"(\d+)(k?m)(?:_|$)", band)
+    if found is None:
+        return default
+    return float(found.group(1)) * (1000 if found.group(2) == "km" else 1)
+
+
+def _add_download_arguments(parser: argparse.ArgumentParser):
+    """
+    The options of the download engine shared by main and batch_main
+    """
+    parser.add_argument(
+        "--rate",
+        help="The maximum number of the requests per second. Default: 1 ",
+        type=float,
+        default=1,
+    )
+    parser.add_argument(
+        "--burst",
+        help="The maximum number of the requests sent at once. Default: 1 ",
+        type=float,
+        default=1,
+    )
+    parser.add_argument(
+        "--max_workers",
+        help="The number of the parallel downloads. Default: 4 ",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--max_in_flight",
+        help="The maximum number of the requests in flight. Default: max_workers ",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--url", help=f"The URL of the service. Default: {URL} ", type=str, default=URL
+    )
+    parser.add_argument(
+        "--retries",
+        help="The maximum number of the retries of each request. Default: 5 ",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--timeout",
+        help="The timeout of the requests in seconds. Default: 120 ",
+        type=float,
+        default=120,
+    )
+    parser.add_argument(
+        "--max_km",
+        help="The maximum km above/below and left/right of the subsets. Default: 100 ",
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        "--dry_run",
+        help="Print the planned requests and data volume without downloading ",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="The directory of the response cache and the job manifest. Default: None ",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--cache_ttl",
+        help="The time to live of the cached responses in days. Default: 30 ",
+        type=float,
+        default=30,
+    )
+    parser.add_argument(
+        "--cache_size",
+        help="The maximum size of the response cache in MB. Default: 1024 ",
+        type=float,
+        default=1024,
+    )
+
+
+@contextlib.contextmanager
+def _downloader_from_args(args, use_manifest: bool = True):
+    """
+    The SubsetDownloader and the JobManifest of the command line options. The HTTP
+    client, the cache and the manifest are closed on exit
+
+    :param use_manifest: Skip the tiles which are done in the manifest
+    """
+    # The retries of the client take their tokens from the bucket of the downloader
+    bucket = TokenBucket(args.rate, args.burst)
+    with contextlib.ExitStack() as stack:
+        client = stack.enter_context(
+            HTTPClient(
+                retries=args.retries,
+                timeout=(10, args.timeout),
+                pool_maxsize=args.max_workers,
+                limiter=bucket.acquire,
+            )
+        )
+        cache, manifest = None, None
+        if args.cache_dir is not None:
+            cache = stack.enter_context(
+                ResponseCache(
+                    os.path.join(args.cache_dir, "responses.sqlite"),
+                    ttl=args.cache_ttl * 86400,
+                    max_size=int(args.cache_size * 1048576),
+                )
+            )
+            manifest = stack.enter_context(
+                JobManifest(os.path.join(args.cache_dir, "manifest.sqlite"))
+            )
+        downloader = SubsetDownloader(
+            url=args.url,
+            rate=args.rate,
+            burst=args.burst,
+            max_workers=args.max_workers,
+            max_in_flight=args.max_in_flight,
+            getter=client.get_json,
+            cache=cache,
+            manifest=manifest if use_manifest else None,
+            bucket=bucket,
+        )
+        yield downloader, manifest
+
+
+def _print_plan(
+    windows, dates: List[str], number_chunks: int, band: str, details: bool = False
+):
+    summary = plan_summary(windows, len(dates), number_chunks, band_pixel_size(band))
+    print(
+        f"Planned: {summary['windows']} windows, {len(dates)} dates, "
+        f"{summary['requests']} requests, {summary['values']} values "
+        f"(~{summary['megabytes']} MB)"
+    )
+    if details:
+        for lon, lat, ab_km, lr_km in windows:
+            print(
+                f"  {lat:.5f}, {lon:.5f}: {ab_km} km above/below, {lr_km} km left/right"
+            )
+
+
+def _convert_to_NetCDF(subsets, coords, ouput_crs, ouput_cellsize):
+    """
+    Save the downloaded subsets of each tile as NetCDF
+
+    :return: The generator of (tile, path of the NetCDF file)
+    """
+    for t, tile_subsets in enumerate(subsets):
+        if tile_subsets is None:
+            continue
+        if sum(len(i["subset"]) for i in tile_subsets) == 0:
+            print(f"No dates for coordinate: {coords[t]}")
+            continue
+        yield t, ut.convert_to_NetCDF(
+            tile_subsets, coords[t], ouput_crs, ouput_cellsize
+        )
+
+
+def _stream_to_NetCDF(responses, coords, number_chunks, ouput_crs, ouput_cellsize):
+    """
+    Append each response to the NetCDF file of its tile as soon as it arrives, so the
+    responses are never held in memory. The file of a tile is closed when all its
+    chunks are written
+
+    :param responses: The generator of `SubsetDownloader.iter_download`
+    :return: The generator of (tile, path of the NetCDF file)
+    """
+    streams, written = {}, {}
+    try:
+        for t, i, n, response in responses:
+            if t not in streams:
+                streams[t] = ut.open_NetCDF_stream(
+                    response, coords[t], ouput_crs, ouput_cellsize
+                )
+            streams[t].append(response, i * number_chunks)
+            written[t] = written.get(t, 0) + 1
+            if written[t] == n:
+                stream = streams.pop(t)
+                stream.close()
+                yield t, stream.path
+    finally:
+        for stream in streams.values():
+            stream.close()
 
 
 def main():
@@ -37,6 +670,19 @@ def main():
     :param ouput_crs: CRS for output. Default: 4326
     :param ouput_cellsize: out put image cellsize. Default: 250
     :param number_chunks: There is a limit of a maximum ten modis dates per reques. Default: 10
+    :param rate: The maximum number of the requests per second. Default: 1
+    :param burst: The maximum number of the requests sent at once. Default: 1
+    :param max_workers: The number of the parallel downloads. Default: 4
+    :param max_in_flight: The maximum number of the requests in flight. Default: max_workers
+    :param url: The URL of the service
+    :param retries: The maximum number of the retries of each request. Default: 5
+    :param timeout: The timeout of the requests in seconds. Default: 120
+    :param max_km: The maximum km above/below and left/right of the subsets. Default: 100
+    :param dry_run: Print the planned requests and data volume without downloading
+    :param stream: Append each response to the NetCDF files as soon as it arrives
+    :param cache_dir: The directory of the response cache and the job manifest. Default: None
+    :param cache_ttl: The time to live of the cached responses in days. Default: 30
+    :param cache_size: The maximum size of the response cache in MB. Default: 1024
     :return: The saved images in the disk
     
     """
@@ -90,203 +736,263 @@ def main():
         default=10,
     )
 
+    parser.add_argument(
+        "--stream",
+        help="Append each response to the NetCDF files as soon as it arrives ",
+        action="store_true",
+    )
+    _add_download_arguments(parser)
+
     args = parser.parse_args()
     satellite = args.satellite
     product = args.product
     band = args.band
 
     # Set subset parameters:
-    url = "https://modis.ornl.gov/rst/api/v1/"
-    header = {"Accept": "application/json"}
-
-    # list of available products.
-    if args.satellite:
-        # print(url + f'products?sensor={satellite}')
-        resp = requests.get(url + f"/products?sensor={satellite}", headers=header)
-        content = resp.json()
-        time.sleep(5)
-        for each in content["products"]:
-            print("%s: %s " % (each["product"], each["description"]))
-
-    #  retrieve available band names for a product
-    if args.product:
-        if band is None:
-            resp = requests.get(url + f"{product}/bands", headers=header)
-            content = resp.json()
-            time.sleep(5)
-            for each in content["bands"]:
-                print("%s: %s " % (each["band"], each["description"]))
-        else:
-            # Get a list of data for product and band:
-
-            path_area_of_interest = args.path_aoi
-            if path_area_of_interest is None:
-                print("Please enter AOI path")
-                sys.exit()
-            crs_area_of_interest = args.crs_aoi
-            if crs_area_of_interest is None:
-                print("Please enter CRS for the AOI")
-                sys.exit()
-
-            startDate = args.startDate
-            if startDate is None:
-                print("Please enter Start Date")
-                sys.exit()
-            endDate = args.endDate
-            if endDate is None:
-                print("Please enter End Date")
-                sys.exit()
-
-            ouput_crs = args.ouput_crs
-            ouput_cellsize = args.ouput_cellsize
-            number_chunks = args.number_chunks
-            if number_chunks > 10 or number_chunks < 1:
-                raise RuntimeError(f"Number should be between 1 and 10")
-
-            region_geometry = ut.geometry_from_geojson(path_area_of_interest)
-            xmin = region_geometry["coordinates"][0][0][0]
-            xmax = region_geometry["coordinates"][0][2][0]
-            ymin = region_geometry["coordinates"][0][0][1]
-            ymax = region_geometry["coordinates"][0][2][1]
-            # https://gis.stackexchange.com/questions/190198/how-to-get-appropriate-crs-for-a-position-specified-in-lat-lon-coordinates
-            zone = round((183 + xmin) / 6)
-            if ymin > 0:
-                EPSG = 32600 + zone
-            else:
-                EPSG = 32700 + zone
-            # https://ocefpaf.github.io/python4oceanographers/blog/2013/12/16/utm/
-            Projection = Proj(
-                f"+proj=utm +zone={zone}K, +south +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
-            )
-            UTMxMin, UTMyMin = Projection(xmin, ymin)
-            UTMxMax, UTMyMax = Projection(xmax, ymax)
-
-            sd = dt.datetime.strptime(startDate, "%Y-%m-%d").date()
-            ed = dt.datetime.strptime(endDate, "%Y-%m-%d").date()
-            ab, lr = 70, 70
-
-            length = UTMxMax - UTMxMin
-            width = UTMyMax - UTMyMin
-            area = (length * width) / 1000000
-            print(f"Area is equal to: {area} m2")
-            if area < 50:
-                print(f"The number of the tiles are: 1")
-                point_long = UTMxMin + length / 2
-                point_lat = UTMyMin + width / 2
-                coords = np.asarray(Projection(point_long, point_lat, inverse=True)).T
-                datesurl = [
-                    url + f"{product}/dates?latitude={coords[1]}&longitude={coords[0]}"
-                ]
-
-                responses = [requests.get(date, headers=header) for date in datesurl]
-                time.sleep(2)
-                dates = [json.loads(resp.text)["dates"] for resp in responses]
-                modis_dates = [
-                    d["modis_date"]
-                    for date in dates
-                    for d in date
-                    if all(
-                        [
-                            dt.datetime.strptime(d["calendar_date"], "%Y-%m-%d").date()
-                            >= sd,
-                            dt.datetime.strptime(d["calendar_date"], "%Y-%m-%d").date()
-                            < ed,
-                        ]
-                    )
-                ]
-
-                chunks = list(ut.chunk(modis_dates, number_chunks))  # type: ignore
-                subsets = []
-                for i, c in enumerate(chunks):
-                    print(
-                        "[ "
-                        + str(i + 1)
-                        + " / "
-                        + str(len(chunks))
-                        + " ] "
-                        + c[0]
-                        + " - "
-                        + c[-1]
-                    )
-                    _url = ut.getSubsetURL(
-                        url, product, coords[1], coords[0], band, c[0], c[-1], ab, lr
-                    )
-                    _response = requests.get(_url, headers=header).json()
-                    time.sleep(3)
-                    subsets.append(_response)
-                ut.convert_to_NetCDF(subsets, coords, ouput_crs, ouput_cellsize)
+    with _downloader_from_args(args) as (downloader, manifest):
+        # list of available products.
+        if args.satellite:
+            for each in downloader.products(satellite):
+                print("%s: %s " % (each["product"], each["description"]))
 
+        #  retrieve available band names for a product
+        if args.product:
+            if band is None:
+                for each in downloader.bands(product):
+                    print("%s: %s " % (each["band"], each["description"]))
             else:
-                grid_UTM = gr.grid(
-                    UTMxMin, UTMxMax, UTMyMin, UTMyMax, cell_size=100000, crs=EPSG
-                ).generate_grid()
-                point_list_UTM = grid_UTM.centroid
-                point_list_WGS = np.asarray(
-                    Projection(
-                        point_list_UTM.x.values, point_list_UTM.y.values, inverse=True
+                # Get a list of data for product and band:
+
+                path_area_of_interest = args.path_aoi
+                if path_area_of_interest is None:
+                    print("Please enter AOI path")
+                    sys.exit()
+                crs_area_of_interest = args.crs_aoi
+                if crs_area_of_interest is None:
+                    print("Please enter CRS for the AOI")
+                    sys.exit()
+
+                startDate = args.startDate
+                if startDate is None:
+                    print("Please enter Start Date")
+                    sys.exit()
+                endDate = args.endDate
+                if endDate is None:
+                    print("Please enter End Date")
+                    sys.exit()
+
+                ouput_crs = args.ouput_crs
+                ouput_cellsize = args.ouput_cellsize
+                number_chunks = args.number_chunks
+                if number_chunks > 10 or number_chunks < 1:
+                    raise RuntimeError(f"Number should be between 1 and 10")
+
+                region_geometry = ut.geometry_from_geojson(path_area_of_interest)
+                sd = dt.datetime.strptime(startDate, "%Y-%m-%d").date()
+                ed = dt.datetime.strptime(endDate, "%Y-%m-%d").date()
+
+                # Cover the AOI with the fewest windows; the dates are the same for all
+                windows = plan_windows(
+                    region_geometry,
+                    args.max_km,
+                    crs_area_of_interest,
+                    band_pixel_size(band, 1000),
+                )
+                print(f"The number of the tiles are: {len(windows)}")
+                if len(windows) == 0:
+                    print("The AOI is empty or has no area")
+                    sys.exit()
+                coords = [(lon, lat) for lon, lat, _, _ in windows]
+                ab = [w[2] for w in windows]
+                lr = [w[3] for w in windows]
+                dates = downloader.dates(product, coords[0][1], coords[0][0], sd, ed)
+                _print_plan(windows, dates, number_chunks, band, args.dry_run)
+                if args.dry_run:
+                    return
+                if len(dates) == 0:
+                    print("No dates between the start and end date")
+                    return
+
+                modis_dates = [dates] * len(windows)
+                if args.stream:
+                    outputs = _stream_to_NetCDF(
+                        downloader.iter_download(
+                            product, band, coords, modis_dates, number_chunks, ab, lr
+                        ),
+                        coords,
+                        number_chunks,
+                        ouput_crs,
+                        ouput_cellsize,
                     )
-                ).T
-                print(f"The number of the tiles are: {len(point_list_WGS)}")
-                datesurl = [
-                    url + f"{product}/dates?latitude={coord[0]}&longitude={coord[1]}"
-                    for coord in point_list_WGS
-                ]
-
-                responses = [requests.get(date, headers=header) for date in datesurl]
-                dates = [json.loads(resp.text)["dates"] for resp in responses]
-                modis_dates = [
-                    [
-                        d["modis_date"]
-                        for d in date
-                        if all(
-                            [
-                                dt.datetime.strptime(
-                                    d["calendar_date"], "%Y-%m-%d"
-                                ).date()
-                                >= sd,
-                                dt.datetime.strptime(
-                                    d["calendar_date"], "%Y-%m-%d"
-                                ).date()
-                                < ed,
-                            ]
-                        )
-                    ]
-                    for date in dates
-                ]
-
-                # divide modis_dates list into increments of 10
-                # assemble url string from subset request parameters
-                # Iterate over groups of dates, request subsets from the REST API, and append to a list of responses:
-                for d, coords in enumerate(point_list_WGS):
-                    print(f"coordinate: {coords}")
-                    chunks = list(ut.chunk(modis_dates[d], number_chunks))  # type: ignore
-                    subsets = []
-                    for i, c in enumerate(chunks):
-                        print(
-                            "[ "
-                            + str(i + 1)
-                            + " / "
-                            + str(len(chunks))
-                            + " ] "
-                            + c[0]
-                            + " - "
-                            + c[-1]
-                        )
-                        _url = ut.getSubsetURL(
-                            url,
-                            product,
-                            coords[1],
-                            coords[0],
-                            band,
-                            c[0],
-                            c[-1],
-                            ab,
-                            lr,
+                else:
+                    outputs = _convert_to_NetCDF(
+                        downloader.download(
+                            product, band, coords, modis_dates, number_chunks, ab, lr
+                        ),
+                        coords,
+                        ouput_crs,
+                        ouput_cellsize,
+                    )
+                for t, output in outputs:
+                    if manifest is not None:
+                        manifest.mark(
+                            downloader.tile_unit(
+                                product, band, coords[t], dates, ab[t], lr[t]
+                            ),
+                            os.path.abspath(output),
                         )
-                        _response = requests.get(_url, headers=header).json()
-                        time.sleep(3)
-                        subsets.append(_response)
-                    ut.convert_to_NetCDF(subsets, coords, ouput_crs, ouput_cellsize)
+
+
+def batch_main():
+    """
+    Download MODIS and VIIRS Land Product Subsets for many AOIs (the features of a GeoJSON
+    file). The windows are planned for all the AOIs together, each window is downloaded
+    once and the windows are mosaicked and clipped for each AOI
+
+    :param product: Available band names for a product.
+    :param band: Name of data layer.
+    :param startDate: Name of data layer. (YYYY-MM-DD')
+    :param endDate: Name of data layer. (YYYY-MM-DD')
+    :param path_aoi: Path for the GeoJSON of the AOIs.
+    :param crs_aoi: CRS for AOI geojson. Default: 4326
+    :param name_field: The property with the name of the AOIs. Default: the index
+    :param out_dir: The directory of the NetCDF files. Default: .
+    :param ouput_crs: CRS for output. Default: 4326
+    :param ouput_cellsize: out put image cellsize. Default: 250
+    :param number_chunks: There is a limit of a maximum ten modis dates per reques. Default: 10
+    :return: The saved images in the disk (output_{name}.nc)
+    """
+    parser = argparse.ArgumentParser(
+        description="MODIS and VIIRS Land Product Subsets for many AOIs"
+    )
+    parser.add_argument("--product", help="The product. ", type=str, required=True)
+    parser.add_argument("--band", help="Name of data layer. ", type=str, required=True)
+    parser.add_argument(
+        "--startDate", help="Start date. (YYYY-MM-DD') ", type=str, required=True
+    )
+    parser.add_argument(
+        "--endDate", help="End date. (YYYY-MM-DD') ", type=str, required=True
+    )
+    parser.add_argument(
+        "--path_aoi", help="Path for the GeoJSON of the AOIs. ", type=str, required=True
+    )
+    parser.add_argument(
+        "--crs_aoi", help="CRS for AOI geojson. Default: 4326 ", type=int, default=4326
+    )
+    parser.add_argument(
+        "--name_field",
+        help="The property with the name of the AOIs. Default: the index ",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--out_dir", help="The directory of the NetCDF files. Default: . ", default="."
+    )
+    parser.add_argument(
+        "--ouput_crs", help="CRS for output. Default: 4326 ", type=int, default=4326
+    )
+    parser.add_argument(
+        "--ouput_cellsize",
+        help="out put image cellsize. Default: 250 ",
+        type=int,
+        default=250,
+    )
+    parser.add_argument(
+        "--number_chunks",
+        help="There is a limit of a maximum ten modis dates per reques. Default: 10 ",
+        type=int,
+        default=10,
+    )
+    _add_download_arguments(parser)
+    args = parser.parse_args()
+    if args.number_chunks > 10 or args.number_chunks < 1:
+        raise RuntimeError(f"Number should be between 1 and 10")
+
+    features = ut.geometries_from_geojson(args.path_aoi)
+    names = [
+        re.sub(r"[^\w.-]+", "_", str(props.get(args.name_field, i)))
+        if args.name_field is not None
+        else str(i)
+        for i, (props, _) in enumerate(features)
+    ]
+    if len(set(names)) != len(names):
+        raise RuntimeError(f"The names of the AOIs are not unique")
+    geometries = [geometry for _, geometry in features]
+    sd = dt.datetime.strptime(args.startDate, "%Y-%m-%d").date()
+    ed = dt.datetime.strptime(args.endDate, "%Y-%m-%d").date()
+
+    # The manifest is used for the AOIs; all the windows of an AOI are needed for its mosaic
+    with _downloader_from_args(args, use_manifest=False) as (downloader, manifest):
+        windows, members = plan_batch(
+            geometries, args.max_km, args.crs_aoi, band_pixel_size(args.band, 1000)
+        )
+        # The hash of the geometry, so an edited AOI with the same name is done again
+        units = [
+            JobManifest.unit(
+                args.product,
+                args.band,
+                name,
+                hashlib.sha1(shapely.geometry.shape(geometry).wkb).hexdigest(),
+                args.crs_aoi,
+                sd,
+                ed,
+                args.ouput_crs,
+                args.ouput_cellsize,
+            )
+            for name, geometry in zip(names, geometries)
+        ]
+        pending = [
+            i
+            for i, unit in enumerate(units)
+            if manifest is None or not manifest.done(unit)
+        ]
+        for i in [i for i in pending if len(members[i]) == 0]:
+            print(f"AOI {names[i]}: empty or no area, skipped")
+            pending.remove(i)
+        needed = sorted({k for i in pending for k in members[i]})
+        print(
+            f"The number of the AOIs are: {len(names)} ({len(pending)} to do), "
+            f"the number of the tiles are: {len(needed)}"
+        )
+        if len(needed) == 0:
+            return
+
+        coords = [windows[k][:2] for k in needed]
+        dates = downloader.dates(args.product, coords[0][1], coords[0][0], sd, ed)
+        _print_plan(
+            [windows[k] for k in needed],
+            dates,
+            args.number_chunks,
+            args.band,
+            args.dry_run,
+        )
+        if args.dry_run or len(dates) == 0:
+            return
+
+        subsets = downloader.download(
+            args.product,
+            args.band,
+            coords,
+            [dates] * len(needed),
+            args.number_chunks,
+            [windows[k][2] for k in needed],
+            [windows[k][3] for k in needed],
+        )
+        tiles = dict(zip(needed, subsets))
+        os.makedirs(args.out_dir, exist_ok=True)
+        for i in pending:
+            output = os.path.join(args.out_dir, f"output_{names[i]}.nc")
+            ut.mosaic_to_NetCDF(
+                [tiles[k] for k in members[i]],
+                geometries[i],
+                output,
+                args.ouput_crs,
+                args.ouput_cellsize,
+                args.crs_aoi,
+            )
+            print(f"AOI {names[i]}: {output}")
+            if manifest is not None:
+                manifest.mark(units[i], os.path.abspath(output))
 
 
 if __name__ == "__main__":
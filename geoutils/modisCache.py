@@ -0,0 +1,197 @@
+# Name: modisCache.py
+# Description: The on-disk cache of the MODIS REST API responses and the manifest of the done jobs
+# Author: Behzad Valipour Sh. <behzad.valipour@swisstph.ch>
+# Date: 18.10.2026
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        path: str,
+        ttl: float = None,  # type: ignore
+        max_size: int = None,  # type: ignore
+    ):
+        """
+        SQLite cache of the JSON responses keyed by the request URL (e.g. the string of
+        `utils.getSubsetURL`). The responses are compressed; the expired responses are
+        dropped when they are read and the least recently used responses are evicted when
+        the cache is larger than max_size
+
+        :param path: The path of the SQLite file
+        :param ttl: The time to live of the responses in seconds; default:None (no expiry)
+        :param max_size: The maximum size of the responses in bytes; default:None (no limit)
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT, "
+                "body BLOB, size INTEGER, created REAL, accessed REAL)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+            )
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def get(self, url: str):
+        """
+        The cached response of the URL
+
+        :return: The decoded JSON or None if it is not cached or expired
+        """
+        key = self.key(url)
+        now = time.time()
+        with self.lock, self.db:
+            row = self.db.execute(
+                "SELECT body, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if self.ttl is not None and now - row[1] > self.ttl:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self.db.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+            )
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, url: str, response):
+        """
+        Cache the JSON response of the URL
+        """
+        body = zlib.compress(json.dumps(response).encode())
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (self.key(url), url, body, len(body), now, now),
+            )
+            if self.max_size is not None:
+                self._evict()
+
+    def _evict(self):
+        """
+        Remove the least recently used responses until the cache fits in max_size
+        """
+        total = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+        if total <= self.max_size:
+            return
+        removed = []
+        for key, size in self.db.execute(
+            "SELECT key, size FROM responses ORDER BY accessed"
+        ).fetchall():
+            if total <= self.max_size:
+                break
+            removed.append((key,))
+            total -= size
+        self.db.executemany("DELETE FROM responses WHERE key = ?", removed)
+
+    def purge(self) -> int:
+        """
+        Remove the expired responses
+
+        :return: The number of the removed responses
+        """
+        if self.ttl is None:
+            return 0
+        with self.lock, self.db:
+            return self.db.execute(
+                "DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,)
+            ).rowcount
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+
+class JobManifest:
+    def __init__(self, path: str):
+        """
+        SQLite manifest of the done units of a download job, e.g. the tiles or the AOIs
+        written to the disk, so a re-run only does what is missing. The responses of the
+        tiles which are not done are read from the ResponseCache
+
+        :param path: The path of the SQLite file
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS units (unit TEXT PRIMARY KEY, "
+                "output TEXT, done REAL)"
+            )
+
+    @staticmethod
+    def unit(*parts) -> str:
+        """
+        The key of the unit e.g. unit(product, band, lat, lon, start, end)
+        """
+        return "|".join(str(p) for p in parts)
+
+    def done(self, unit: str) -> bool:
+        """
+        Check if the unit is done. A unit with an output is only done while the output exists
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT output FROM units WHERE unit = ?", (unit,)
+            ).fetchone()
+        if row is None:
+            return False
+        return row[0] is None or os.path.exists(row[0])
+
+    def mark(self, unit: str, output: str = None):  # type: ignore
+        """
+        Record the unit as done
+
+        :param unit: The key of the unit
+        :param output: The file written by the unit; default:None
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO units VALUES (?, ?, ?)",
+                (unit, output, time.time()),
+            )
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM units").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
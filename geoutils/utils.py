@@ -1,16 +1,40 @@
 import datetime as dt
+import hashlib
 import json
 import os
+import warnings
+from collections import OrderedDict
 
 import numpy as np
-import numpy.ma as ma
 import rioxarray
 import xarray as xr
-from pyproj import CRS, Proj  # type: ignore
+import shapely
+import shapely.geometry
+import shapely.ops
+from affine import Affine
+from pyproj import CRS, Proj, Transformer  # type: ignore
+from rasterio.features import rasterize
+from rasterio.warp import calculate_default_transform
+from scipy.spatial import cKDTree
 
 
 # ModisAPI.py utils:
 def geometry_from_geojson(filepath: str):
+    features = geometries_from_geojson(filepath)
+    if len(features) > 1:
+        raise IOError(
+            f"More than one feature contained in {filepath}, must be exactly 1"
+        )
+    return features[0][1]
+
+
+def geometries_from_geojson(filepath: str):
+    """
+    Read all the polygons of a GeoJSON file (e.g. a FeatureCollection with many AOIs)
+
+    :param filepath: The path of the GeoJSON file
+    :return: The list of (properties, geometry) of the features
+    """
     with open(filepath, "r") as f:
         json_obj = json.load(f)
 
@@ -19,28 +43,34 @@ def geometry_from_geojson(filepath: str):
         features = json_obj["features"]
         if len(features) == 0:
             raise IOError(f"No features contained in {filepath}")
-        elif len(features) > 1:
-            raise IOError(
-                f"More than one feature contained in {filepath}, must be exactly 1"
-            )
-
-        feature = features[0]
-        ftype = feature["geometry"]["type"]
-        if ftype not in ["Polygon", "MultiPolygon"]:
-            raise IOError(
-                f"Feature type in {filepath} must be either Polygon or MultiPolygon"
-            )
-
-        return feature["geometry"]
+        for feature in features:
+            ftype = feature["geometry"]["type"]
+            if ftype not in ["Polygon", "MultiPolygon"]:
+                raise IOError(
+                    f"Feature type in {filepath} must be either Polygon or MultiPolygon"
+                )
+        return [(f.get("properties") or {}, f["geometry"]) for f in features]
 
     elif geojson_type in ["Polygon", "MultiPolygon"]:
-        return json_obj
+        return [({}, json_obj)]
     else:
         raise IOError(
             f"Feature type in {filepath} must be either FeatureCollection, Polygon or MultiPolygon"
         )
 
 
+def transform_geometry(transformer: Transformer, geometry):
+    """
+    Transform the coordinates of the Shapely geometry with the pyproj Transformer
+    """
+    if hasattr(shapely, "transform"):
+        return shapely.transform(
+            geometry,
+            lambda c: np.column_stack(transformer.transform(c[:, 0], c[:, 1])),
+        )
+    return shapely.ops.transform(transformer.transform, geometry)
+
+
 """yield successive n-sized chunks from list l"""
 
 
@@ -86,90 +116,655 @@ def getSubsetURL(
     )
 
 
-def convert_to_NetCDF(subsets, coords, ouput_crs, ouput_cellsize):
-    # Use dictionary comprehension to get some spatial metadata from the first subset in our list:
-    meta = {key: value for key, value in subsets[0].items() if key != "subset"}
-    # Iterate over the list of subsets and collect the data in a dictionary:
-    data = {"dates": [], "arrays": []}
+SINUSOIDAL = "+proj=sinu +lon_0=0 +x_0=0 +y_0=0 +a=6371007.181 +b=6371007.181 +units=m"
+
+
+def subset_coords(meta):
+    """
+    The x and y coordinates of the subset (the centers of the cells, y ascending). The
+    xllcorner and yllcorner of the API are the left-low corner of the first cell
+    """
+    x = float(meta["xllcorner"]) + (np.arange(meta["ncols"]) + 0.5) * meta["cellsize"]
+    y = float(meta["yllcorner"]) + (np.arange(meta["nrows"]) + 0.5) * meta["cellsize"]
+    return x, y
+
+
+def _subset_slices(subsets, meta):
+    """
+    Yield the date and the (y, x) array of each date. The rows of the API start from the
+    top, so they are flipped to match the ascending y
+    """
     for i in subsets:
         for j in i["subset"]:
-            data["dates"].append(j["calendar_date"])
-            data["arrays"].append(
-                np.array(j["data"]).reshape(meta["nrows"], meta["ncols"])
-            )
-
-    # Use the metadata to make lists of x and y coordinates:
-    # f(ncols,nrows): n * cellsize + corner_coordinate
-    dtdates = [dt.datetime.strptime(d, "%Y-%m-%d") for d in data["dates"]]
-    xcoordinates = [float(meta["xllcorner"])] + [
-        i * meta["cellsize"] + float(meta["xllcorner"]) for i in range(1, meta["ncols"])
-    ]
-    ycoordinates = [float(meta["yllcorner"])] + [
-        i * meta["cellsize"] + float(meta["yllcorner"]) for i in range(1, meta["nrows"])
-    ]
-    # Make an xarray.DataArray object:
-
-    xrDataArray = xr.DataArray(
-        name=meta["band"],
-        data=np.flipud(np.dstack(data["arrays"])),
-        coords=[np.array(ycoordinates), np.array(xcoordinates), dtdates],  # type: ignore
-        dims=["y", "x", "time"],
-        attrs=dict(units=meta["units"]),
+            values = np.asarray(j["data"]).reshape(meta["nrows"], meta["ncols"])
+            yield j["calendar_date"], values[::-1]
+
+
+class NetCDFStream:
+    def __init__(self, path: str, meta, plan: "ReprojectionPlan" = None):  # type: ignore
+        """
+        Write the subsets of the MODIS REST API to a NetCDF file as they arrive, appending
+        the dates along the unlimited time dimension. The responses can arrive in any
+        order if their position in the time dimension is given
+
+        :param path: The path of the NetCDF file
+        :param meta: The metadata of the subsets (nrows, ncols, cellsize, xllcorner,
+            yllcorner, band and units)
+        :param plan: The reprojection of the subsets; default:None (MODIS sinusoidal)
+        """
+        import netCDF4
+
+        self.path = path
+        self.meta = meta
+        self.plan = plan
+        if plan is None:
+            x, y = subset_coords(meta)
+            crs = SINUSOIDAL
+        else:
+            x, y, crs = plan.x, plan.y, plan.crs
+        self.ds = netCDF4.Dataset(path, "w", format="NETCDF4")
+        self.ds.createDimension("time", None)
+        self.ds.createDimension("y", len(y))
+        self.ds.createDimension("x", len(x))
+        self.ds.createVariable("x", "f8", ("x",))[:] = x
+        self.ds.createVariable("y", "f8", ("y",))[:] = y
+        self.time = self.ds.createVariable("time", "i8", ("time",))
+        self.time.units = "days since 1970-01-01"
+        self.time.calendar = "proleptic_gregorian"
+        spatial_ref = self.ds.createVariable("spatial_ref", "i8")
+        spatial_ref.crs_wkt = CRS.from_user_input(crs).to_wkt()
+        spatial_ref.spatial_ref = spatial_ref.crs_wkt
+        self.variable = None
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, subset, index: int = None):  # type: ignore
+        """
+        Append the dates of one response of the /subset request
+
+        :param subset: The response
+        :param index: The position of the first date of the response in the time
+            dimension; default:None (after the last written date)
+        """
+        if index is None:
+            index = self.count
+        for k, (date, values) in enumerate(_subset_slices([subset], self.meta)):
+            if self.variable is None:
+                fill_value = None
+                if self.plan is not None:
+                    fill_value = default_nodata(values.dtype)
+                self.variable = self.ds.createVariable(
+                    self.meta["band"],
+                    values.dtype,
+                    ("time", "y", "x"),
+                    zlib=True,
+                    fill_value=fill_value,
+                )
+                self.variable.units = self.meta["units"]
+                self.variable.grid_mapping = "spatial_ref"
+            if self.plan is not None:
+                values = self.plan.apply(values[None])[0]
+            days = (dt.datetime.strptime(date, "%Y-%m-%d") - dt.datetime(1970, 1, 1)).days
+            self.time[index + k] = days
+            self.variable[index + k] = values
+            self.count = max(self.count, index + k + 1)
+
+    def close(self):
+        self.ds.close()
+
+
+REPROJECTION_CACHE_SIZE = 16
+_REPROJECTION_CACHE = OrderedDict()
+
+
+def default_nodata(dtype):
+    """
+    The fill value of the cells outside of the source (the same as rioxarray)
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f":
+        return np.nan
+    if dtype.kind == "u":
+        return np.iinfo(dtype).max
+    return np.iinfo(dtype).min
+
+
+class ReprojectionPlan:
+    def __init__(self, meta, dst_crs, resolution=None, src_crs: str = SINUSOIDAL):
+        """
+        Nearest neighbour warp of the subsets of the MODIS REST API to the CRS. The source
+        cell of each destination cell is computed once, so every date is reprojected with
+        one gather. The destination grid is the same as `rio.reproject`
+
+        :param meta: The metadata of the subsets (nrows, ncols, cellsize, xllcorner and
+            yllcorner)
+        :param dst_crs: The CRS of the output
+        :param resolution: The cell size of the output; default:None (same number of cells)
+        :param src_crs: The CRS of the subsets; default:MODIS sinusoidal
+        """
+        nrows, ncols, cs = meta["nrows"], meta["ncols"], meta["cellsize"]
+        # xllcorner and yllcorner are the left-low corner of the first cell
+        left, bottom = float(meta["xllcorner"]), float(meta["yllcorner"])
+        right, top = left + ncols * cs, bottom + nrows * cs
+        self.transform, width, height = calculate_default_transform(
+            src_crs,
+            dst_crs,
+            ncols,
+            nrows,
+            left,
+            bottom,
+            right,
+            top,
+            resolution=resolution,
+        )
+        self.shape = (int(height), int(width))
+        self.crs = dst_crs
+        self.x = self.transform.c + (np.arange(width) + 0.5) * self.transform.a
+        self.y = self.transform.f + (np.arange(height) + 0.5) * self.transform.e
+
+        xx, yy = np.meshgrid(self.x, self.y)
+        src_x, src_y = Transformer.from_crs(dst_crs, src_crs, always_xy=True).transform(
+            xx.ravel(), yy.ravel()
+        )
+        cols = np.floor((np.asarray(src_x) - left) / cs)
+        rows = np.floor((np.asarray(src_y) - bottom) / cs)
+        valid = (cols >= 0) & (cols < ncols) & (rows >= 0) & (rows < nrows)
+        self.dst_index = np.flatnonzero(valid)
+        # The subsets are stored with ascending y
+        self.src_index = rows[valid].astype("int64") * ncols + cols[valid].astype("int64")
+
+    def apply(self, cube, nodata=None):
+        """
+        Reproject the (time, y, x) cube with y ascending
+
+        :param nodata: The value of the cells outside of the source; default:None (NaN or
+            the limit of the integer type)
+        :return: The (time, y, x) cube on the destination grid (y descending)
+        """
+        cube = np.asarray(cube)
+        if nodata is None:
+            nodata = default_nodata(cube.dtype)
+        flat = cube.reshape(len(cube), -1)
+        out = np.full((len(cube), self.shape[0] * self.shape[1]), nodata, cube.dtype)
+        out[:, self.dst_index] = flat[:, self.src_index]
+        return out.reshape((len(cube),) + self.shape)
+
+
+def get_reprojection_plan(
+    meta, dst_crs, resolution=None, src_crs: str = SINUSOIDAL
+) -> ReprojectionPlan:
+    """
+    The reprojection plan of the subset geometry. The plans are kept in memory with LRU
+    eviction, so the tiles with the same geometry reuse the warp
+    """
+    key = (
+        float(meta["xllcorner"]),
+        float(meta["yllcorner"]),
+        float(meta["cellsize"]),
+        int(meta["nrows"]),
+        int(meta["ncols"]),
+        str(dst_crs),
+        resolution,
+        src_crs,
     )
-    # Finally, save as netCDF:
-    xrDataArray_T = xrDataArray.transpose("time", "y", "x")
-    crs = "+proj=sinu +lon_0=0 +x_0=0 +y_0=0 +a=6371007.181 +b=6371007.181 +units=m"
-    xrDataArray_CRS = xrDataArray_T.rio.write_crs(crs)
+    if key in _REPROJECTION_CACHE:
+        _REPROJECTION_CACHE.move_to_end(key)
+        return _REPROJECTION_CACHE[key]
+    plan = ReprojectionPlan(meta, dst_crs, resolution, src_crs)
+    _REPROJECTION_CACHE[key] = plan
+    if len(_REPROJECTION_CACHE) > REPROJECTION_CACHE_SIZE:
+        _REPROJECTION_CACHE.popitem(last=False)
+    return plan
+
+
+def convert_to_NetCDF(subsets, coords, ouput_crs, ouput_cellsize, stream=False):
+    """
+    Save the subsets of the MODIS REST API as NetCDF in the output CRS. The warp of the
+    subset geometry is computed once (see `get_reprojection_plan`) and the (time, y, x)
+    array is allocated once and filled in place with the reprojected dates
+
+    :param subsets: The responses of the /subset requests
+    :param coords: The (longitude, latitude) of the center of the subsets
+    :param ouput_crs: The EPSG code of the output CRS
+    :param ouput_cellsize: The cell size of the output (not used for 4326)
+    :param stream: Append the dates to the file one response at a time with NetCDFStream
+        instead of building the array in memory; default:False
+    :return: The path of the NetCDF file
+    """
+    if stream:
+        with open_NetCDF_stream(subsets[0], coords, ouput_crs, ouput_cellsize) as nc:
+            for subset in subsets:
+                nc.append(subset)
+        return nc.path
+
+    # Use dictionary comprehension to get some spatial metadata from the first subset in our list:
+    meta = {key: value for key, value in subsets[0].items() if key != "subset"}
+    output = f"output_{coords[0]}_{coords[1]}.nc"
+    plan = _output_plan(meta, ouput_crs, ouput_cellsize)
+
+    # Allocate the array once and fill it with the reprojected dates
+    count = sum(len(i["subset"]) for i in subsets)
+    if count == 0:
+        raise RuntimeError(f"The subsets have no dates")
+    dates = []
+    data, nodata = None, None
+    for t, (date, values) in enumerate(_subset_slices(subsets, meta)):
+        if data is None:
+            nodata = default_nodata(values.dtype)
+            data = np.full((count,) + plan.shape, nodata, dtype=values.dtype)
+        elif not np.can_cast(values.dtype, data.dtype):
+            data = data.astype(np.result_type(data.dtype, values.dtype))
+        data[t].flat[plan.dst_index] = values.ravel()[plan.src_index]
+        dates.append(date)
+
+    return _write_cube(meta, dates, data, plan, nodata, output)
+
+
+def open_NetCDF_stream(
+    subset, coords, ouput_crs, ouput_cellsize
+) -> NetCDFStream:
+    """
+    Open the NetCDFStream of the tile in the output CRS (the same file as
+    `convert_to_NetCDF`) from any response of its /subset requests
+
+    :param subset: A response of the /subset requests of the tile
+    :param coords: The (longitude, latitude) of the center of the tile
+    :param ouput_crs: The EPSG code of the output CRS
+    :param ouput_cellsize: The cell size of the output (not used for 4326)
+    """
+    meta = {key: value for key, value in subset.items() if key != "subset"}
+    plan = _output_plan(meta, ouput_crs, ouput_cellsize)
+    return NetCDFStream(f"output_{coords[0]}_{coords[1]}.nc", meta, plan)
+
 
+def _output_plan(meta, ouput_crs, ouput_cellsize) -> ReprojectionPlan:
     if ouput_crs != 4326:
         if ouput_cellsize is None:
             raise RuntimeError(f"Please determine the cell size for projection")
-        else:
+        return get_reprojection_plan(meta, f"EPSG:{ouput_crs}", ouput_cellsize)
+    return get_reprojection_plan(meta, f"EPSG:{ouput_crs}")
 
-            file = xrDataArray_CRS.rio.reproject(
-                f"epsg:{ouput_crs}", resolution=ouput_cellsize
-            )
-    else:
-        file = xrDataArray_CRS.rio.reproject(f"epsg:{ouput_crs}")
 
-    xrDataArray_CRS.to_netcdf(
-        f"output_{coords[0]}_{coords[1]}.nc", unlimited_dims="time", engine="netcdf4"
+def _write_cube(meta, dates, data, plan, nodata, output):
+    """
+    Save the reprojected (time, y, x) cube as NetCDF
+    """
+    xrDataArray_CRS = (
+        xr.DataArray(
+            name=meta["band"],
+            data=data,
+            coords=[np.array(dates, dtype="datetime64[ns]"), plan.y, plan.x],  # type: ignore
+            dims=["time", "y", "x"],
+            attrs=dict(units=meta["units"]),
+        )
+        .rio.write_crs(plan.crs)
+        .rio.write_nodata(nodata, encoded=False)
+    )
+    xrDataArray_CRS.to_netcdf(output, unlimited_dims="time", engine="netcdf4")
+    return output
+
+
+def mosaic_subsets(tiles, geometry, crs=4326):
+    """
+    Mosaic the subsets of the windows which cover the AOI and clip them to the AOI. The
+    windows are on the same sinusoidal grid, so they are placed without resampling; the
+    cells which do not touch the AOI are set to nodata
+
+    :param tiles: The responses of the /subset requests of each window (same dates)
+    :param geometry: The GeoJSON geometry (or the Shapely geometry) of the AOI
+    :param crs: The EPSG code of the AOI; default:4326
+    :return: The metadata of the mosaic, the dates, the (time, y, x) cube with y ascending
+        and the nodata value
+    """
+    if len(tiles) == 0:
+        raise RuntimeError(f"No window covers the AOI")
+    if not hasattr(geometry, "geom_type"):
+        geometry = shapely.geometry.shape(geometry)
+    aoi = transform_geometry(
+        Transformer.from_crs(crs, SINUSOIDAL, always_xy=True), geometry
+    )
+    metas = [{k: v for k, v in t[0].items() if k != "subset"} for t in tiles]
+    cs = metas[0]["cellsize"]
+    x0 = float(metas[0]["xllcorner"])
+    y0 = float(metas[0]["yllcorner"])
+    # The offsets of the windows in the cells of the first window
+    offsets = [
+        (
+            int(round((float(m["yllcorner"]) - y0) / cs)),
+            int(round((float(m["xllcorner"]) - x0) / cs)),
+        )
+        for m in metas
+    ]
+
+    # The cells of the windows which touch the bounds of the AOI
+    minx, miny, maxx, maxy = aoi.bounds
+    r_lo = max(min(r for r, _ in offsets), int(np.floor((miny - y0) / cs)))
+    r_hi = min(
+        max(r + m["nrows"] for (r, _), m in zip(offsets, metas)),
+        int(np.ceil((maxy - y0) / cs)),
+    )
+    c_lo = max(min(c for _, c in offsets), int(np.floor((minx - x0) / cs)))
+    c_hi = min(
+        max(c + m["ncols"] for (_, c), m in zip(offsets, metas)),
+        int(np.ceil((maxx - x0) / cs)),
+    )
+    if r_lo >= r_hi or c_lo >= c_hi:
+        raise RuntimeError(f"The windows do not cover the AOI")
+    meta = dict(
+        metas[0],
+        xllcorner=x0 + c_lo * cs,
+        yllcorner=y0 + r_lo * cs,
+        nrows=r_hi - r_lo,
+        ncols=c_hi - c_lo,
     )
 
+    dates = [j["calendar_date"] for i in tiles[0] for j in i["subset"]]
+    index = {d: t for t, d in enumerate(dates)}
+    data, nodata = None, None
+    for (r, c), m, subsets in zip(offsets, metas, tiles):
+        # The part of the window in the mosaic
+        wr0, wr1 = max(r_lo - r, 0), min(r_hi - r, m["nrows"])
+        wc0, wc1 = max(c_lo - c, 0), min(c_hi - c, m["ncols"])
+        if wr0 >= wr1 or wc0 >= wc1:
+            continue
+        for date, values in _subset_slices(subsets, m):
+            if date not in index:
+                continue
+            if data is None:
+                nodata = default_nodata(values.dtype)
+                shape = (len(dates), meta["nrows"], meta["ncols"])
+                data = np.full(shape, nodata, dtype=values.dtype)
+            data[
+                index[date],
+                r + wr0 - r_lo : r + wr1 - r_lo,
+                c + wc0 - c_lo : c + wc1 - c_lo,
+            ] = values[wr0:wr1, wc0:wc1]
+
+    # Clip to the AOI; the rasterized rows start from the top
+    transform = Affine(
+        cs,
+        0,
+        meta["xllcorner"],
+        0,
+        -cs,
+        meta["yllcorner"] + meta["nrows"] * cs,
+    )
+    inside = rasterize(
+        [(aoi, 1)],
+        out_shape=(meta["nrows"], meta["ncols"]),
+        transform=transform,
+        all_touched=True,
+    ).astype(bool)[::-1]
+    if data is not None:
+        data[:, ~inside] = nodata
+    return meta, dates, data, nodata
+
+
+def mosaic_to_NetCDF(tiles, geometry, output, ouput_crs, ouput_cellsize, crs=4326):
+    """
+    Save the mosaic of the windows clipped to the AOI (see `mosaic_subsets`) as NetCDF in
+    the output CRS
+
+    :return: The path of the NetCDF file
+    """
+    meta, dates, data, nodata = mosaic_subsets(tiles, geometry, crs)
+    plan = _output_plan(meta, ouput_crs, ouput_cellsize)
+    return _write_cube(meta, dates, plan.apply(data, nodata), plan, nodata, output)
+
 
 # Define the help function to be used in the main function
+TREE_CACHE_SIZE = 8
+_TREE_CACHE = OrderedDict()
+STATS = {
+    "mean": lambda w: np.nanmean(w, axis=1),
+    "median": lambda w: np.nanmedian(w, axis=1),
+    "min": lambda w: np.nanmin(w, axis=1),
+    "max": lambda w: np.nanmax(w, axis=1),
+    "std": lambda w: np.nanstd(w, axis=1),
+    "count": lambda w: np.count_nonzero(~np.isnan(w), axis=1),
+}
+
+
+def integral_image(b):
+    """
+    Calculate the summed-area table of the band. The table has one extra row and
+    column of zeros so the sum of any window is four lookups
+
+    :param b: The band as 2D array
+    :return: The summed-area table with shape (height + 1, width + 1) as float64
+    """
+    sat = np.zeros((b.shape[0] + 1, b.shape[1] + 1), dtype="float64")
+    np.cumsum(np.cumsum(b, axis=0, dtype="float64"), axis=1, out=sat[1:, 1:])
+    return sat
+
+
+def buffer_bounds(shape, rc, s):
+    """
+    Calculate the window around the points clipped to the band extent
+
+    :param shape: The shape of the band (height, width)
+    :param rc: The row/col of the points as (N, 2) array
+    :param s: The number of pixels around the point
+    :return: The first and last (exclusive) row and col of the windows
+    """
+    rc = np.asarray(rc, dtype="int64").reshape(-1, 2)
+    r0 = np.clip(rc[:, 0] - s, 0, shape[0])
+    r1 = np.clip(rc[:, 0] + (s + 1), 0, shape[0])
+    c0 = np.clip(rc[:, 1] - s, 0, shape[1])
+    c1 = np.clip(rc[:, 1] + (s + 1), 0, shape[1])
+    return r0, r1, c0, c1
+
+
+def window_sum(sat, r0, r1, c0, c1):
+    """
+    Sum of the windows using the summed-area table
+    """
+    return sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0]
+
+
+def rowcol_from_transform(transform, x, y):
+    """
+    Calculate the row/col of the points from the affine transform of the raster
+
+    :param transform: The affine transform of the raster
+    :param x: The X coordinates of the points
+    :param y: The Y coordinates of the points
+    :return: The row/col of the points as (N, 2) array
+    """
+    cols, rows = ~transform * (
+        np.asarray(x, dtype="float64"),
+        np.asarray(y, dtype="float64"),
+    )
+    return np.stack([np.floor(rows), np.floor(cols)], axis=1).astype("int64")
+
+
+def inside_band(shape, rc):
+    """
+    Check which points are inside of the band extent
+    """
+    rc = np.asarray(rc, dtype="int64").reshape(-1, 2)
+    return (
+        (rc[:, 0] >= 0)
+        & (rc[:, 0] < shape[0])
+        & (rc[:, 1] >= 0)
+        & (rc[:, 1] < shape[1])
+    )
+
+
+def _valid_pixel_tree(valid):
+    """
+    Build the KD-tree over the centre of the valid pixels. The tree is cached for the mask
+    """
+    key = hashlib.sha1(
+        np.packbits(valid).tobytes() + repr(valid.shape).encode()
+    ).hexdigest()
+    if key not in _TREE_CACHE:
+        pixels = np.argwhere(valid)
+        tree = cKDTree(pixels + 0.5) if len(pixels) else None
+        _TREE_CACHE[key] = (tree, pixels)
+        if len(_TREE_CACHE) > TREE_CACHE_SIZE:
+            _TREE_CACHE.popitem(last=False)
+    _TREE_CACHE.move_to_end(key)
+    return _TREE_CACHE[key]
+
+
+def nearest_valid_pixel(valid, rc, max_distance: float):
+    """
+    Move the points which are outside of the band or on the invalid pixels (e.g. nodata,
+    coastlines) to the nearest valid pixel. The KD-tree over the valid pixels is built
+    once per mask and all the points are resolved in one query
+
+    :param valid: The mask of the valid pixels as 2D boolean array
+    :param rc: The row/col of the points as (N, 2) array
+    :param max_distance: The maximum distance to search in pixels
+    :return: The row/col of the points and which points were substituted
+    """
+    rc = np.asarray(rc, dtype="int64").reshape(-1, 2)
+    valid = np.asarray(valid, dtype=bool)
+    inside = inside_band(valid.shape, rc)
+    ok = inside.copy()
+    ok[inside] = valid[rc[inside, 0], rc[inside, 1]]
+
+    resolved = rc.copy()
+    substituted = np.zeros(len(rc), dtype=bool)
+    failing = np.flatnonzero(~ok)
+    if len(failing) == 0:
+        return resolved, substituted
+
+    tree, pixels = _valid_pixel_tree(valid)
+    if tree is None:
+        return resolved, substituted
+    distance, nearest = tree.query(
+        rc[failing] + 0.5, distance_upper_bound=max_distance
+    )
+    found = np.isfinite(distance)
+    resolved[failing[found]] = pixels[nearest[found]]
+    substituted[failing[found]] = True
+    return resolved, substituted
+
+
 def extract_point(b, rc):
     """
-    Extract the value for the points
+    Extract the value for the points. The points outside of the band are NaN
     """
-    extracted_values = [b[coord[0], coord[1]] for coord in rc]
+    rc = np.asarray(rc, dtype="int64").reshape(-1, 2)
+    inside = inside_band(b.shape, rc)
+    extracted_values = np.full(
+        len(rc), np.nan, dtype=np.result_type(b.dtype, np.float32)
+    )
+    extracted_values[inside] = b[rc[inside, 0], rc[inside, 1]]
     return extracted_values
 
 
+def window_mean(b, rc, s, valid):
+    """
+    The mean of the valid pixels in the windows around the points. The sum of the finite
+    pixels and the counts are calculated from separate summed-area tables, so the
+    infinite pixels only affect the windows which contain them (inf, -inf or NaN if
+    both, as np.mean). The windows are clipped to the band extent and the points
+    outside of the band are NaN
+
+    :param b: The band as 2D array
+    :param rc: The row/col of the points as (N, 2) array
+    :param s: The number of pixels around the point
+    :param valid: The mask of the pixels used in the mean as 2D boolean array
+    :return: The mean and the number of the valid pixels of the windows
+    """
+    r0, r1, c0, c1 = buffer_bounds(b.shape, rc, s)
+    finite = valid & np.isfinite(b)
+    total = window_sum(integral_image(np.where(finite, b, 0)), r0, r1, c0, c1)
+    count = window_sum(integral_image(valid), r0, r1, c0, c1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        extracted_values = np.where(count > 0, total / count, np.nan)
+    if (valid & ~finite).any():
+        posinf = window_sum(integral_image(valid & (b == np.inf)), r0, r1, c0, c1)
+        neginf = window_sum(integral_image(valid & (b == -np.inf)), r0, r1, c0, c1)
+        extracted_values[posinf > 0] = np.inf
+        extracted_values[neginf > 0] = -np.inf
+        extracted_values[(posinf > 0) & (neginf > 0)] = np.nan
+    extracted_values[~inside_band(b.shape, rc)] = np.nan
+    return extracted_values, count
+
+
 def extract_point_buffer(b, rc, s):
     """
-    Extract the value based on the surrounded buffer
+    Extract the value based on the surrounded buffer. The mean of every window is
+    calculated from the summed-area tables, so the cost is O(H*W + N) per band.
+    The windows are clipped to the band extent, the windows including NaN are NaN
+    and the points outside of the band are NaN
     """
-    extracted_values = [
-        np.mean(b[coord[0] - s : coord[0] + (s + 1), coord[1] - s : coord[1] + (s + 1)])
-        for coord in rc
-    ]
+    r0, r1, c0, c1 = buffer_bounds(b.shape, rc, s)
+    extracted_values, count = window_mean(b, rc, s, ~np.isnan(b))
+    extracted_values[count < (r1 - r0) * (c1 - c0)] = np.nan
     return extracted_values
 
 
 def extract_point_buffer_mask(b, rc, s, nd):
     """
-    Extract the value based on the surrounded buffer and mask the nodata value in calculation
+    Extract the value based on the surrounded buffer and mask the nodata value in calculation.
+    The mean is the sum of the valid pixels divided by the count of the valid pixels,
+    both calculated from summed-area tables. The points outside of the band are NaN
     """
-    extracted_values = [
-        np.nanmean(
-            ma.masked_values(
-                b[coord[0] - s : coord[0] + (s + 1), coord[1] - s : coord[1] + (s + 1)],
-                nd,
-            ).filled(np.nan)
-        )
-        for coord in rc
-    ]
+    valid = ~(np.isclose(b, nd) | np.isnan(b))
+    return window_mean(b, rc, s, valid)[0]
+
+
+def extract_point_buffer_stats(b, rc, s, stats, nd=None, batch_size=65536):
+    """
+    Extract several statistics of the surrounded buffer in one pass. The windows are
+    gathered at the points only from a strided window view of the band and all the
+    statistics are calculated on the same windows. The pixels outside of the band, NaN
+    and the nodata value (if determined) are ignored
+
+    :param b: The band as 2D array
+    :param rc: The row/col of the points as (N, 2) array
+    :param s: The number of pixels around the point
+    :param stats: The list of the statistics: mean, median, min, max, std, count or pNN for percentiles e.g. p90
+    :param nd: The nodata value to mask; default:None
+    :param batch_size: The number of points gathered at once to bound the memory
+    :return: The dictionary of the extracted values for each statistic
+    """
+    percentiles = {}
+    for stat in stats:
+        if stat.startswith("p") and stat[1:].replace(".", "", 1).isdigit():
+            percentiles[stat] = float(stat[1:])
+        elif stat not in STATS:
+            raise NameError(f"{stat} is not supported. Use {list(STATS)} or pNN")
+
+    b = np.asarray(b, dtype="float32")
+    if nd is not None:
+        b = np.where(np.isclose(b, nd), np.nan, b)
+    windows = np.lib.stride_tricks.sliding_window_view(
+        np.pad(b, s, constant_values=np.nan), (2 * s + 1, 2 * s + 1)
+    )
+
+    rc = np.asarray(rc, dtype="int64").reshape(-1, 2)
+    inside = inside_band(b.shape, rc)
+    extracted_values = {
+        stat: np.full(len(rc), np.nan, dtype="float32") for stat in stats
+    }
+    idx_inside = np.flatnonzero(inside)
+    step = max(batch_size // (2 * s + 1) ** 2, 1)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for i in range(0, len(idx_inside), step):
+            idx = idx_inside[i : i + step]
+            w = windows[rc[idx, 0], rc[idx, 1]].reshape(len(idx), -1)
+            for stat in stats:
+                if stat in percentiles:
+                    continue
+                extracted_values[stat][idx] = STATS[stat](w)
+            if percentiles:
+                q = np.nanpercentile(w, list(percentiles.values()), axis=1)
+                for stat, values in zip(percentiles, q):
+                    extracted_values[stat][idx] = values
+
     return extracted_values
 
 
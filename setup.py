@@ -34,13 +34,16 @@ setup(
         "rasterio",
         "netcdf4",
         "requests",
+        "scipy",
         "scikit-learn",
         "xlsxwriter",
         "coloredlogs",
     ],
+    extras_require={"parquet": ["pyarrow"]},
     entry_points={
         "console_scripts": [
             "modisAPI=geoutils.modisAPI:main",
+            "modisBatch=geoutils.modisAPI:batch_main",
             "LandsatGLAD=geoutils.LandsatGLAD:main",
         ]
     },
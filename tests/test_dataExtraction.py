@@ -0,0 +1,107 @@
+import geopandas as gpd
+import numpy as np
+import rasterio as rs
+import rioxarray
+import xarray as xr
+from affine import Affine
+
+from geoutils.dataExtraction import extract_geotif_to_point
+
+TRANSFORM = Affine(10, 0, 1000, 0, -10, 5000)
+
+
+def _edge_points(path, shape, n=500, seed=0):
+    """
+    The points on and around the raster including the rows/cols just outside of it
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.concatenate([rng.uniform(-3, shape[0] + 3, n), [-2, -0.5, shape[0] + 1]])
+    cols = np.concatenate([rng.uniform(-3, shape[1] + 3, n), [5, 399.5, -1]])
+    x, y = TRANSFORM * (cols, rows)
+    gdf = gpd.GeoDataFrame(geometry=gpd.points_from_xy(x, y), crs=2056)
+    gdf.to_file(path, driver="GeoJSON")
+    return str(path)
+
+
+def _raster(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    band = rng.normal(size=shape).astype("float32")
+    band[rng.random(shape) < 0.01] = 0
+    band[rng.random(shape) < 0.005] = np.nan
+    return band
+
+
+def test_windowed_matches_full_read(tmp_path):
+    shape = (301, 402)
+    band = _raster(shape)
+    rast_path = tmp_path / "tiled.tif"
+    with rs.open(
+        rast_path,
+        "w",
+        driver="GTiff",
+        height=shape[0],
+        width=shape[1],
+        count=1,
+        dtype="float32",
+        crs="EPSG:2056",
+        transform=TRANSFORM,
+        tiled=True,
+        blockxsize=64,
+        blockysize=64,
+    ) as dst:
+        dst.write(band, 1)
+    gdf_path = _edge_points(tmp_path / "points.geojson", shape)
+
+    for kwargs in [
+        dict(resample_size=0),
+        dict(resample_size=50),
+        dict(resample_size=50, mask=True),
+        dict(resample_size=50, stats=["mean", "max", "p90"]),
+    ]:
+        full = extract_geotif_to_point(str(rast_path), "d", gdf_path, **kwargs)
+        windowed = extract_geotif_to_point(
+            str(rast_path), "d", gdf_path, windowed=True, **kwargs
+        )
+        columns = [c for c in full.columns if c != "geometry"]
+        # The summed-area tables of the blocks round differently from the full band
+        np.testing.assert_allclose(
+            full[columns].to_numpy(dtype="float64"),
+            windowed[columns].to_numpy(dtype="float64"),
+            rtol=1e-5,
+            atol=1e-6,
+        )
+        # The points outside of the raster are NaN in both modes
+        assert full[columns].iloc[-3:].isna().all().all()
+
+
+def test_chunked_matches_eager(tmp_path):
+    shape = (301, 402)
+    cube = np.stack([_raster(shape, seed) for seed in range(3)])
+    cols, rows = np.arange(shape[1]) + 0.5, np.arange(shape[0]) + 0.5
+    x, _ = TRANSFORM * (cols, np.zeros_like(cols))
+    _, y = TRANSFORM * (np.zeros_like(rows), rows)
+    da = xr.DataArray(
+        cube,
+        dims=("time", "y", "x"),
+        coords={"time": ["2020", "2021", "2022"], "y": y, "x": x},
+    ).rio.write_crs(2056)
+    gdf_path = _edge_points(tmp_path / "points.geojson", shape)
+
+    for kwargs in [
+        dict(resample_size=0),
+        dict(resample_size=50),
+        dict(resample_size=50, mask=True),
+        dict(resample_size=50, stats=["mean", "max", "p90"]),
+    ]:
+        eager = extract_geotif_to_point(da, "d", gdf_path, **kwargs)
+        chunked = extract_geotif_to_point(
+            da.chunk({"time": 1, "y": 64, "x": 64}), "d", gdf_path, **kwargs
+        )
+        columns = [c for c in eager.columns if c != "geometry"]
+        np.testing.assert_allclose(
+            eager[columns].to_numpy(dtype="float64"),
+            chunked[columns].to_numpy(dtype="float64"),
+            rtol=1e-5,
+            atol=1e-6,
+        )
+        assert eager[columns].iloc[-3:].isna().all().all()
@@ -0,0 +1,105 @@
+import math
+import random
+import threading
+import time
+
+import shapely
+import shapely.geometry
+import shapely.ops
+from pyproj import Transformer
+
+from geoutils import utils as ut
+from geoutils.modisAPI import SubsetDownloader, TokenBucket, plan_windows
+
+
+class FakeGetter:
+    """
+    The getter of SubsetDownloader which records the time of the requests and the
+    number of the requests in flight instead of calling the service
+    """
+
+    def __init__(self, delay: float = 0.02):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def __call__(self, url, headers=None):
+        with self.lock:
+            self.calls.append((time.monotonic(), url))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        # Random delays, so the responses complete out of order
+        time.sleep(random.uniform(0, self.delay))
+        with self.lock:
+            self.in_flight -= 1
+        return {"url": url}
+
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(rate=50, capacity=1)
+    start = time.monotonic()
+    for _ in range(11):
+        bucket.acquire()
+    # The first token is free, the next ten are added at 50 per second
+    assert time.monotonic() - start >= 10 / 50 * 0.9
+
+
+def test_download_order_and_rate_cap():
+    rate, burst, max_in_flight = 40, 2, 2
+    getter = FakeGetter()
+    downloader = SubsetDownloader(
+        url="http://mock/",
+        rate=rate,
+        burst=burst,
+        max_workers=6,
+        max_in_flight=max_in_flight,
+        getter=getter,
+    )
+    coords = [(8.5, 47.3), (8.7, 47.4)]
+    dates = [[f"A2020{d:03d}" for d in range(1, 366, 16)]] * len(coords)
+    subsets = downloader.download("MOD13Q1", "NDVI", coords, dates, 5, 1, 1)
+
+    # The responses of each tile are in the order of the date chunks
+    for (lon, lat), tile_dates, tile_subsets in zip(coords, dates, subsets):
+        expected = [
+            ut.getSubsetURL(
+                "http://mock/", "MOD13Q1", lat, lon, "NDVI", c[0], c[-1], 1, 1
+            )
+            for c in ut.chunk(tile_dates, 5)
+        ]
+        assert [s["url"] for s in tile_subsets] == expected
+    assert len(getter.calls) == 10
+
+    # The first burst requests are sent at once, the others at the rate
+    times = sorted(t for t, _ in getter.calls)
+    assert times[-1] - times[0] >= (len(times) - burst) / rate * 0.9
+    assert getter.max_in_flight <= max_in_flight
+
+
+def test_plan_windows_cover_aoi():
+    # The service snaps the center to its pixel and cuts a whole number of the pixels
+    # on each side; the 250 m MODIS pixels are 231.656 m in the sinusoidal projection
+    pixel = 231.65635826395825
+    to_sinusoidal = Transformer.from_crs(4326, ut.SINUSOIDAL, always_xy=True)
+    for aoi in [
+        shapely.geometry.box(8, 46.5, 9, 47.5),
+        shapely.geometry.box(20, 60, 30, 65),
+        shapely.geometry.Polygon([(6, 46), (6.3, 46), (11, 48.8), (10.7, 48.8)]),
+    ]:
+        footprints = []
+        for lon, lat, ab, lr in plan_windows(aoi, pixel_size=250):
+            x, y = to_sinusoidal.transform(lon, lat)
+            col, row = math.floor(x / pixel), math.floor(y / pixel)
+            nab, nlr = int(ab * 1000 / pixel), int(lr * 1000 / pixel)
+            footprints.append(
+                shapely.geometry.box(
+                    (col - nlr) * pixel,
+                    (row - nab) * pixel,
+                    (col + nlr + 1) * pixel,
+                    (row + nab + 1) * pixel,
+                )
+            )
+        aoi = ut.transform_geometry(to_sinusoidal, shapely.segmentize(aoi, 0.001))
+        assert shapely.ops.unary_union(footprints).contains(aoi)